@@ -0,0 +1,56 @@
+"""
+count TLS handshakes and time a parse with many HTTPS @includes served
+from a local stand-in server, with and without a shared session
+
+    python benchmarks/bench_include_sessions.py
+"""
+
+import os
+import sys
+import tempfile
+import time
+from io import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from sedge.engine import SedgeEngine  # noqa: E402
+from sedge.keylib import KeyLibrary  # noqa: E402
+from sedge.urlhandling import get_contents  # noqa: E402
+from tests.conftest import make_certificate, start_server  # noqa: E402
+
+N_INCLUDES = 30
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        certfile, keyfile = make_certificate(tmpdir)
+        server = start_server(certfile, keyfile)
+        for i in range(N_INCLUDES):
+            server.pages["/%d.sedge" % i] = "Host remote%d\n" % i
+        urls = [server.url("/%d.sedge" % i) for i in range(N_INCLUDES)]
+
+        start = time.perf_counter()
+        for url in urls:
+            get_contents(url, certfile)
+        elapsed = time.perf_counter() - start
+        print(
+            "no session:     %3d includes, %3d handshakes, %.3fs"
+            % (N_INCLUDES, server.connections, elapsed)
+        )
+
+        server.connections = 0
+        text = "".join("@include %s\n" % t for t in urls)
+        library = KeyLibrary("/does-not-exist", verbose=False)
+        start = time.perf_counter()
+        SedgeEngine(library, StringIO(text), certfile)
+        elapsed = time.perf_counter() - start
+        print(
+            "engine session: %3d includes, %3d handshakes, %.3fs"
+            % (N_INCLUDES, server.connections, elapsed)
+        )
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
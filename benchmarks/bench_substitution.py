@@ -0,0 +1,82 @@
+"""
+compare the compiled Template substitution against the previous approach
+of running str.replace for every variable on every line
+
+    python benchmarks/bench_substitution.py
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from sedge.engine import Template  # noqa: E402
+
+
+def replace_substitutions(lines, val_dict):
+    # the substitution loop used prior to Template
+    for line in lines:
+        for subst, value in val_dict.items():
+            line = line.replace(subst, value)
+        yield line
+
+
+def make_workload(n_hosts, n_lines, n_vars):
+    names = ["<var%d>" % t for t in range(n_vars)]
+    lines = ["node<i>"] + [
+        "    Option%d = <var%d>-value" % (t, t % n_vars) for t in range(n_lines)
+    ]
+    base = dict((t, t.strip("<>") + "-val") for t in names)
+    val_dicts = []
+    for i in range(n_hosts):
+        val_dict = base.copy()
+        val_dict["<i>"] = str(i)
+        val_dicts.append(val_dict)
+    return lines, names + ["<i>"], val_dicts
+
+
+def timed(fn):
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+def main():
+    print(
+        "%8s %6s %6s %12s %12s %8s"
+        % ("hosts", "lines", "vars", "replace", "template", "speedup")
+    )
+    for n_hosts, n_lines, n_vars in (
+        (1000, 10, 5),
+        (1000, 10, 50),
+        (10000, 10, 20),
+        (10000, 20, 50),
+        (40000, 10, 50),
+    ):
+        lines, names, val_dicts = make_workload(n_hosts, n_lines, n_vars)
+
+        def run_replace():
+            for val_dict in val_dicts:
+                list(replace_substitutions(lines, val_dict))
+
+        def run_template():
+            template = Template(lines, names)
+            for val_dict in val_dicts:
+                list(template.render(val_dict))
+
+        # sanity check: both paths must agree
+        template = Template(lines, names)
+        assert list(template.render(val_dicts[0])) == list(
+            replace_substitutions(lines, val_dicts[0])
+        )
+        t_replace = timed(run_replace)
+        t_template = timed(run_template)
+        print(
+            "%8d %6d %6d %11.3fs %11.3fs %7.1fx"
+            % (n_hosts, n_lines, n_vars, t_replace, t_template, t_replace / t_template)
+        )
+
+
+if __name__ == "__main__":
+    main()
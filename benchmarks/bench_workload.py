@@ -0,0 +1,306 @@
+"""
+time parsing, stanza expansion and output of synthetic configurations,
+and measure their peak memory. results are written as JSON, so that runs
+against different commits can be compared.
+
+    python benchmarks/bench_workload.py > before.json
+    python benchmarks/bench_workload.py --hosts 5000 --with-size 20
+
+with no workload options, a built-in set of scenarios is run. "parse"
+is the construction of the SedgeEngine: parsing the configuration and
+its @includes, and resolving each @identity against the key library.
+"""
+
+import argparse
+import base64
+import gc
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from io import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from sedge.engine import SedgeEngine, ConfigOutput  # noqa: E402
+from sedge.keylib import KeyLibrary  # noqa: E402
+
+DEFAULTS = {
+    # Host stanzas, spread across the root and included files
+    "hosts": 200,
+    # @with keywords per Host stanza, and the values each takes
+    "with_vars": 1,
+    "with_size": 10,
+    # @HostAttrs inherit from `is_fanout` attrs on the next level down,
+    # `is_depth` levels deep; each host has @is for one top-level attr
+    "is_depth": 2,
+    "is_fanout": 2,
+    # @set variables, each used by every host
+    "variables": 5,
+    # keys in the key library, and the fraction of hosts with @identity
+    "keys": 10,
+    "identity_density": 0.5,
+    # the tree of local @includes below the root
+    "include_depth": 1,
+    "include_fanout": 2,
+}
+
+SCENARIOS = {
+    "small": {},
+    "wide-with": {"hosts": 50, "with_vars": 2, "with_size": 30},
+    "deep-is": {"hosts": 2000, "with_size": 1, "is_depth": 6, "is_fanout": 2},
+    "many-hosts": {"hosts": 20000, "with_size": 1, "include_depth": 2},
+    "many-variables": {"hosts": 1000, "variables": 100},
+    "identities": {"hosts": 5000, "with_size": 1, "keys": 200, "identity_density": 1},
+    "include-tree": {"hosts": 2000, "include_depth": 3, "include_fanout": 4},
+}
+
+
+def public_key(rng):
+    key_type = b"ssh-ed25519"
+    key_bytes = bytes(rng.getrandbits(8) for _ in range(32))
+    blob = b"".join(
+        [len(key_type).to_bytes(4, "big"), key_type, len(key_bytes).to_bytes(4, "big")]
+    )
+    blob += key_bytes
+    return "ssh-ed25519 " + base64.b64encode(blob).decode("ascii")
+
+
+def make_keys(key_dir, n_keys, rng):
+    """
+    writes n_keys placeholder keys with public keys alongside, returning
+    their SHA256 fingerprints
+    """
+    fingerprints = []
+    for i in range(n_keys):
+        fname = os.path.join(key_dir, "id_bench%d" % i)
+        line = public_key(rng)
+        with open(fname, "w") as fd:
+            fd.write("placeholder\n")
+        with open(fname + ".pub", "w") as fd:
+            fd.write(line + " bench%d\n" % i)
+        fingerprints.append(KeyLibrary._fingerprints_from_public_key(line)[0])
+    return fingerprints
+
+
+def include_tree(depth, fanout):
+    """
+    returns {file index: [child file index, ...]} for a tree of files
+    `depth` levels below the root (index 0), each with `fanout` children
+    """
+    children = {0: []}
+    level = [0]
+    for _ in range(depth):
+        next_level = []
+        for parent in level:
+            for _ in range(fanout):
+                child = len(children)
+                children[child] = []
+                children[parent].append(child)
+                next_level.append(child)
+        level = next_level
+    return children
+
+
+def make_workload(directory, params, seed=0):
+    """
+    writes a synthetic configuration, its includes and a key library to
+    directory, returning (path of the root configuration, key directory)
+    """
+    rng = random.Random(seed)
+    key_dir = os.path.join(directory, "keys")
+    os.mkdir(key_dir)
+    fingerprints = make_keys(key_dir, params["keys"], rng)
+    children = include_tree(params["include_depth"], params["include_fanout"])
+    paths = dict((t, os.path.join(directory, "config%d.sedge" % t)) for t in children)
+
+    # variables and attrs are local to each file, so each file has its own
+    preamble = []
+    for i in range(params["variables"]):
+        preamble.append("@set var%d value%d" % (i, i))
+    for level in range(params["is_depth"]):
+        for j in range(params["is_fanout"]):
+            preamble.append("@HostAttrs attr%d_%d" % (level, j))
+            preamble.append("    SetEnv ATTR%d_%d=<var0>" % (level, j))
+            if level + 1 < params["is_depth"]:
+                for k in range(params["is_fanout"]):
+                    preamble.append("    @is attr%d_%d" % (level + 1, k))
+    texts = dict((t, list(preamble)) for t in children)
+    # keys defined in the root are passed down to every include
+    texts[0] = [
+        "@key key%d %s" % (i, fingerprint) for i, fingerprint in enumerate(fingerprints)
+    ] + preamble
+
+    identity_every = (
+        int(round(1 / params["identity_density"])) if params["identity_density"] else 0
+    )
+    with_vars = ["w%d" % t for t in range(params["with_vars"])]
+    for n in range(params["hosts"]):
+        lines = texts[n % len(children)]
+        for var in with_vars:
+            lines.append("@with %s {0..%d}" % (var, params["with_size"] - 1))
+        name = "-".join(["h%d" % n] + ["<%s>" % t for t in with_vars])
+        lines.append("Host %s" % name)
+        lines.append("    HostName %s.example.org" % name)
+        lines.append(
+            "    User " + "-".join("<var%d>" % t for t in range(params["variables"]))
+        )
+        if params["is_depth"]:
+            lines.append("    @is attr0_%d" % (n % params["is_fanout"]))
+        if identity_every and params["keys"] and n % identity_every == 0:
+            lines.append("    @identity key%d" % (n % params["keys"]))
+
+    for index, lines in texts.items():
+        lines = lines + ['@include "%s"' % paths[t] for t in children[index]]
+        with open(paths[index], "w") as fd:
+            fd.write("\n".join(lines) + "\n")
+    return paths[0], key_dir
+
+
+def run_phases(config_file, key_dir):
+    """
+    yields (phase name, function) for each phase, in order; each function
+    uses the result of the one before
+    """
+    state = {}
+
+    def parse():
+        library = KeyLibrary(key_dir, verbose=False)
+        with open(config_file) as fd:
+            state["engine"] = SedgeEngine(library, fd, True)
+
+    def host_stanzas():
+        count = 0
+        for engine in state["engine"].engines():
+            for _ in engine.host_stanzas():
+                count += 1
+        state["stanzas"] = count
+
+    def output():
+        fd = StringIO()
+        state["engine"].output(ConfigOutput(fd))
+        state["bytes"] = len(fd.getvalue())
+
+    yield "parse", parse
+    yield "host_stanzas", host_stanzas
+    yield "output", output
+    yield "done", lambda: state
+
+
+def measure(config_file, key_dir, repeat):
+    """
+    returns the best wall time of each phase over `repeat` runs, and the
+    peak memory allocated during each phase (measured in a separate run,
+    as tracing slows everything down)
+    """
+    times = {}
+    for _ in range(repeat):
+        for name, fn in run_phases(config_file, key_dir):
+            if name == "done":
+                counts = fn()
+                break
+            gc.collect()
+            start = time.perf_counter()
+            fn()
+            elapsed = time.perf_counter() - start
+            times[name] = min(times.get(name, elapsed), elapsed)
+
+    peak = {}
+    tracemalloc.start()
+    for name, fn in run_phases(config_file, key_dir):
+        if name == "done":
+            break
+        gc.collect()
+        tracemalloc.reset_peak()
+        base, _ = tracemalloc.get_traced_memory()
+        fn()
+        _, high = tracemalloc.get_traced_memory()
+        peak[name] = high - base
+    tracemalloc.stop()
+
+    return {
+        "seconds": times,
+        "peak_bytes": peak,
+        "stanzas": counts["stanzas"],
+        "output_bytes": counts["bytes"],
+    }
+
+
+def git_revision():
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "HEAD"],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=subprocess.DEVNULL,
+            )
+            .decode("ascii")
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    for name, default in DEFAULTS.items():
+        parser.add_argument(
+            "--" + name.replace("_", "-"),
+            type=type(default),
+            default=None,
+            help="default: %s" % default,
+        )
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    custom = dict(
+        (t, getattr(args, t)) for t in DEFAULTS if getattr(args, t) is not None
+    )
+    if custom:
+        scenarios = {"custom": custom}
+    else:
+        names = args.scenario or sorted(SCENARIOS)
+        scenarios = dict((t, SCENARIOS[t]) for t in names)
+
+    results = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "repeat": args.repeat,
+        "scenarios": {},
+    }
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # output() records the hosts it writes in ~/.sedge/hosts
+        os.environ["HOME"] = tmpdir
+        os.mkdir(os.path.join(tmpdir, ".sedge"))
+        for name, overrides in scenarios.items():
+            params = dict(DEFAULTS, **overrides)
+            directory = os.path.join(tmpdir, name)
+            os.mkdir(directory)
+            config_file, key_dir = make_workload(directory, params, args.seed)
+            result = measure(config_file, key_dir, args.repeat)
+            result["params"] = params
+            results["scenarios"][name] = result
+            print(
+                "%-16s %8d stanzas  parse %.3fs  host_stanzas %.3fs  output %.3fs"
+                % (
+                    name,
+                    result["stanzas"],
+                    result["seconds"]["parse"],
+                    result["seconds"]["host_stanzas"],
+                    result["seconds"]["output"],
+                ),
+                file=sys.stderr,
+            )
+    json.dump(results, sys.stdout, indent=2, sort_keys=True)
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,14 @@
+import functools
+
+
+@functools.lru_cache(maxsize=None)
+def sedge_version():
+    """
+    the installed version of sedge, or "unknown"
+    """
+    try:
+        from importlib.metadata import version
+
+        return version("sedge")
+    except Exception:
+        return "unknown"
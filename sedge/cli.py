@@ -1,4 +1,4 @@
-import difflib
+import json
 import os.path
 import sys
 from pathlib import Path
@@ -6,9 +6,10 @@ from tempfile import NamedTemporaryFile
 
 import click
 
-from .engine import SedgeEngine, ConfigOutput
-from .keylib import KeyLibrary
+# the rest of sedge is imported by the commands which use it, so that
+# `sedge complete' (run on each completion) doesn't pay for loading it
 from .templates import sedge_config_header
+from .timings import timings
 
 
 def get_file_backup_name(file_name):
@@ -70,7 +71,9 @@ def check_or_confirm_output_overwrite(file_name):
         return prompt()
 
 
-def diff_config_changes(before, after):
+def diff_config_changes(before, after, max_lines=None):
+    from .configdiff import stanza_diff
+
     def get_data(f):
         try:
             with open(f) as fd:
@@ -81,12 +84,22 @@ def diff_config_changes(before, after):
 
     a = get_data(before)
     b = get_data(after)
-    diff_lines = list(difflib.unified_diff(a, b))
-    if not diff_lines:
+    if a == b:
         click.echo("no changes.", err=True)
     else:
         click.echo("configuration changes:", err=True)
-        click.echo("".join(diff_lines), err=True)
+        click.echo("".join(stanza_diff(a, b, max_lines)), err=True)
+
+
+def open_key_library(config, verbose=False):
+    from .keylib import KeyLibrary
+
+    return KeyLibrary(
+        path=config.key_directory,
+        verbose=verbose,
+        cache_path=os.path.expanduser("~/.sedge/keys.json"),
+        ignore=config.key_ignore,
+    )
 
 
 class SedgeConfig:
@@ -115,15 +128,38 @@ sedge_config = click.make_pass_decorator(SedgeConfig, ensure=True)
     default=os.path.expanduser("~/.ssh"),
     help="directory to scan for SSH keys",
 )
+@click.option(
+    "--key-ignore",
+    multiple=True,
+    metavar="PATTERN",
+    help="skip matching names when scanning for SSH keys",
+)
 @click.option("-v", "--verbose", count=True, default=0)
+@click.option(
+    "--max-diff-lines",
+    default=1000,
+    metavar="N",
+    help="show at most N lines of diff with -v",
+)
 @sedge_config
-def cli(config, verbose, key_directory, no_verify, output_file, config_file):
+def cli(
+    config,
+    max_diff_lines,
+    verbose,
+    key_ignore,
+    key_directory,
+    no_verify,
+    output_file,
+    config_file,
+):
     """
     Template and share OpenSSH ssh_config(5) files. A preprocessor for
     OpenSSH configurations.
     """
     config.verbose = verbose
+    config.max_diff_lines = max_diff_lines or None
     config.key_directory = key_directory
+    config.key_ignore = key_ignore
     config.config_file = config_file
     config.output_file = output_file
     config.no_verify = no_verify
@@ -136,7 +172,6 @@ def init(config):
     Initialise ~./sedge/config file if none exists.
     Good for first time sedge usage
     """
-    from pkg_resources import resource_stream
     import shutil
 
     config_file = Path(config.config_file)
@@ -147,32 +182,336 @@ def init(config):
         sys.exit()
 
     config_file.parent.mkdir(parents=True, exist_ok=True)
-    with resource_stream(__name__, "sedge_template.conf") as src_stream:
+    template_file = os.path.join(os.path.dirname(__file__), "sedge_template.conf")
+    with open(template_file, "rb") as src_stream:
         with open(config.config_file, "wb") as target_stream:
             shutil.copyfileobj(src_stream, target_stream)
 
 
 @cli.command("update")
+@click.option(
+    "--timings",
+    "timings_format",
+    type=click.Choice(["text", "json"]),
+    help="report the time taken by each phase of the update",
+)
+@click.option(
+    "--profile",
+    metavar="PATH",
+    help="write cProfile statistics for the update to PATH",
+)
+@click.option(
+    "--fragments",
+    is_flag=True,
+    help="write each source to its own file, under sedge.d/",
+)
+@click.option(
+    "--max-hosts",
+    type=int,
+    metavar="N",
+    help="abort if the output would have more than N hosts",
+)
+@click.option(
+    "--max-bytes",
+    type=int,
+    metavar="N",
+    help="abort if the output would be larger than about N bytes",
+)
 @sedge_config
-def update(config):
+def update(config, max_bytes, max_hosts, fragments, profile, timings_format):
     """
     Update ssh config from sedge specification
     """
+    config_file = Path(config.config_file)
+    if not config_file.is_file():
+        click.echo("No file {} ".format(config_file), err=True)
+        sys.exit()
+
+    config.fragments = fragments
+    config.max_hosts = max_hosts
+    config.max_bytes = max_bytes
+    if timings_format is not None:
+        timings.enabled = True
+    profiler = None
+    if profile is not None:
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        with timings.phase("update"):
+            update_config(config)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile)
+        if timings_format == "json":
+            click.echo(json.dumps(timings.report(), indent=2, sort_keys=True), err=True)
+        elif timings_format == "text":
+            click.echo("\n".join(timings.format()), err=True)
+
+
+def update_config(config):
+    from .manifest import UpdateManifest
+    from .urlhandling import IncludeCache
+
+    library = open_key_library(config)
+    include_cache = IncludeCache(os.path.expanduser("~/.sedge/cache"))
+    manifest = UpdateManifest(os.path.expanduser("~/.sedge/manifest.json"))
+    options = update_options(config)
+    if config.output_file != "-":
+        with timings.phase("manifest check"):
+            current = manifest.is_current(
+                config.output_file,
+                options,
+                library,
+                not config.no_verify,
+                include_cache,
+            )
+        if current:
+            # nothing has changed since we last wrote the output
+            if config.verbose:
+                click.echo("no changes.", err=True)
+            return
+
+    with timings.phase("parse"):
+        engine = open_engine(config, library, include_cache)
+    if config.max_hosts is not None or config.max_bytes is not None:
+        with timings.phase("plan"):
+            check_budget(config, engine)
+
+    write_config(config, engine, library, manifest, options)
+
+
+def open_engine(config, library, include_cache):
+    from .engine import SedgeEngine
+    from .parsecache import ParseCache
+
+    with open(config.config_file) as fd:
+        return SedgeEngine(
+            library,
+            fd,
+            not config.no_verify,
+            url=config.config_file,
+            include_cache=include_cache,
+            parse_cache=ParseCache(os.path.expanduser("~/.sedge/cache/parsed")),
+        )
+
+
+def plan_stanzas(engine):
+    """
+    returns [(url, location, name, (hosts, lines, bytes)), ...] for
+    engine's Host stanzas, in output order
+    """
+    return [
+        (url, "{}:{}".format(url, host.lineno), host.name, estimate)
+        for url, host, estimate in engine.plan()
+    ]
+
+
+def check_budget(config, engine):
+    """
+    exit, before any output is rendered, if the output would have more
+    hosts or bytes than the budgets set by --max-hosts and --max-bytes
+    """
+    stanzas = plan_stanzas(engine)
+    hosts = sum(t[3][0] for t in stanzas)
+    size = sum(t[3][2] for t in stanzas)
+    over = []
+    if config.max_hosts is not None and hosts > config.max_hosts:
+        over.append(
+            "{} hosts, more than --max-hosts {}".format(hosts, config.max_hosts)
+        )
+    if config.max_bytes is not None and size > config.max_bytes:
+        over.append(
+            "about {} bytes, more than --max-bytes {}".format(size, config.max_bytes)
+        )
+    if not over:
+        return
+    click.echo("error: the output would have {}.".format(" and ".join(over)), err=True)
+    click.echo("the largest Host stanzas are:", err=True)
+    for _, location, name, (n_hosts, _, n_bytes) in sorted(
+        stanzas, key=lambda t: t[3][2], reverse=True
+    )[:5]:
+        click.echo(
+            "  {} {}: {} hosts, about {} bytes".format(
+                location, name, n_hosts, n_bytes
+            ),
+            err=True,
+        )
+    click.echo("{} has not been changed.".format(config.output_file), err=True)
+    sys.exit(1)
+
+
+@cli.command("query")
+@click.argument("hostname")
+@sedge_config
+def query(config, hostname):
+    """
+    Show the ssh config generated for a host
+    """
+    from .engine import ConfigOutput
+    from .urlhandling import IncludeCache
+
+    config_file = Path(config.config_file)
+    if not config_file.is_file():
+        click.echo("No file {} ".format(config_file), err=True)
+        sys.exit()
+
+    library = open_key_library(config)
+    engine = open_engine(
+        config, library, IncludeCache(os.path.expanduser("~/.sedge/cache"))
+    )
+
+    out = ConfigOutput(sys.stdout)
+    found = False
+    for url, lineno, lines in engine.query(hostname):
+        found = True
+        out.write_stanza(["# {}:{}".format(url, lineno)] + lines)
+    if not found:
+        click.echo("no configuration for host '{}'".format(hostname), err=True)
+        sys.exit(1)
+
+
+@cli.command("plan")
+@sedge_config
+def plan(config):
+    """
+    Estimate the size of the ssh config, without generating it
+    """
+    from .urlhandling import IncludeCache
+
+    config_file = Path(config.config_file)
+    if not config_file.is_file():
+        click.echo("No file {} ".format(config_file), err=True)
+        sys.exit()
+
+    library = open_key_library(config)
+    engine = open_engine(
+        config, library, IncludeCache(os.path.expanduser("~/.sedge/cache"))
+    )
+
+    stanzas = plan_stanzas(engine)
+    row = "{:>10} {:>10} {:>12}  {}"
+    click.echo(row.format("hosts", "lines", "bytes", "stanza"))
+    for url in dict.fromkeys(t[0] for t in stanzas):
+        in_source = [t for t in stanzas if t[0] == url]
+        for _, location, name, (hosts, lines, size) in in_source:
+            click.echo(row.format(hosts, lines, size, "{} {}".format(location, name)))
+        if len(stanzas) > len(in_source):
+            subtotals = [sum(t[3][i] for t in in_source) for i in range(3)]
+            click.echo(row.format(*subtotals, "subtotal for {}".format(url)))
+    totals = [sum(t[3][i] for t in stanzas) for i in range(3)]
+    click.echo(row.format(*totals, "total"))
+
+
+@cli.command("complete")
+@click.argument("prefix", default="")
+def complete(prefix):
+    """
+    List the hosts whose names start with a prefix
+    """
+    from .completion import CompletionIndex
 
-    def write_to(out):
-        engine.output(out)
+    try:
+        index = CompletionIndex(os.path.expanduser("~/.sedge/hosts.idx"))
+    except (OSError, ValueError):
+        # not yet written by `sedge update'
+        return
+    try:
+        for host in index.complete(prefix):
+            click.echo(host)
+    finally:
+        index.close()
+
+
+@cli.command("watch")
+@click.option(
+    "--debounce",
+    default=0.5,
+    show_default=True,
+    help="seconds to wait for changes to settle",
+)
+@click.option(
+    "--remote-interval",
+    default=300,
+    show_default=True,
+    help="seconds between checks of HTTPS includes",
+)
+@click.option("--poll", is_flag=True, help="poll for changes instead of using inotify")
+@click.option(
+    "--fragments",
+    is_flag=True,
+    help="write each source to its own file, under sedge.d/",
+)
+@sedge_config
+def watch(config, fragments, poll, remote_interval, debounce):
+    """
+    Keep ssh config up to date as the sedge specification changes
+    """
+    from .manifest import UpdateManifest
+    from .parsecache import ParseCache
+    from .urlhandling import IncludeCache
+    from .watch import ConfigWatch, make_watcher, watch_loop
 
     config_file = Path(config.config_file)
     if not config_file.is_file():
         click.echo("No file {} ".format(config_file), err=True)
         sys.exit()
 
-    library = KeyLibrary(config.key_directory)
-    with config_file.open() as fd:
-        engine = SedgeEngine(library, fd, not config.no_verify, url=config.config_file)
+    config.fragments = fragments
+    library = open_key_library(config)
+    include_cache = IncludeCache(os.path.expanduser("~/.sedge/cache"))
+    manifest = UpdateManifest(os.path.expanduser("~/.sedge/manifest.json"))
+    options = update_options(config)
+    config_watch = ConfigWatch(
+        config.config_file,
+        library,
+        not config.no_verify,
+        include_cache,
+        ParseCache(os.path.expanduser("~/.sedge/cache/parsed")),
+    )
+
+    def regenerate(engine):
+        write_config(config, engine, library, manifest, options)
+
+    regenerate(config_watch.engine)
+    try:
+        watch_loop(
+            config_watch,
+            make_watcher(poll=poll),
+            regenerate,
+            debounce=debounce,
+            remote_interval=remote_interval,
+        )
+    except KeyboardInterrupt:
+        pass
+
+
+def update_options(config):
+    """
+    the options which, along with the input files, determine the output
+    """
+    return {
+        "config_file": config.config_file,
+        "verify": not config.no_verify,
+        "key_directory": config.key_directory,
+        "key_ignore": list(config.key_ignore),
+        "fragments": config.fragments,
+    }
+
+
+def write_config(config, engine, library, manifest, options):
+    """
+    write the configuration generated by engine to the output file, via a
+    temporary file so that the output is replaced atomically
+    """
+    from .engine import ConfigOutput
+    from .fragments import FragmentWriter
 
     if config.output_file == "-":
-        write_to(ConfigOutput(sys.stdout))
+        with timings.phase("output"):
+            engine.output(ConfigOutput(sys.stdout))
         return
 
     # ensure that there is a directory for output
@@ -186,19 +525,46 @@ def update(config):
         click.echo("Aborting.", err=True)
         sys.exit(1)
 
-    tmp_file = NamedTemporaryFile(
-        mode="w", dir=os.path.dirname(config.output_file), delete=False
-    )
-    try:
-        tmp_file.file.write(sedge_config_header.format(config.config_file))
-        write_to(ConfigOutput(tmp_file.file))
-        tmp_file.close()
+    def show_diff(path, new_path):
         if config.verbose:
-            diff_config_changes(config.output_file, tmp_file.name)
-        os.replace(tmp_file.name, config.output_file)
-    except Exception:
-        os.unlink(tmp_file.name)
-        raise
+            with timings.phase("diff"):
+                if path != config.output_file:
+                    click.echo("{}:".format(path), err=True)
+                diff_config_changes(path, new_path, config.max_diff_lines)
+
+    if config.fragments:
+        writer = FragmentWriter(os.path.join(config_dir, "sedge.d"))
+        with timings.phase("output"):
+            output_files = writer.write(
+                engine,
+                config.output_file,
+                sedge_config_header.format(config.config_file),
+                on_replace=show_diff,
+            )
+    else:
+        tmp_file = NamedTemporaryFile(
+            mode="w", dir=config_dir, prefix=".sedge-", delete=False
+        )
+        try:
+            with timings.phase("output"):
+                tmp_file.file.write(sedge_config_header.format(config.config_file))
+                engine.output(ConfigOutput(tmp_file.file))
+                tmp_file.close()
+            show_diff(config.output_file, tmp_file.name)
+            os.replace(tmp_file.name, config.output_file)
+        except Exception:
+            os.unlink(tmp_file.name)
+            raise
+        output_files = [config.output_file]
+    hosts_file = os.path.expanduser("~/.sedge/hosts")
+    with timings.phase("record"):
+        manifest.record(
+            config.output_file,
+            options,
+            engine,
+            library,
+            output_files + [hosts_file, hosts_file + ".idx"],
+        )
 
 
 @cli.group()
@@ -212,12 +578,12 @@ def keys(config):
 @keys.command("list")
 @sedge_config
 def command_list_keys(config):
-    library = KeyLibrary(path=config.key_directory, verbose=config.verbose)
+    library = open_key_library(config, verbose=config.verbose)
     library.list_keys()
 
 
 @keys.command("add")
 @sedge_config
 def command_add_keys(config):
-    library = KeyLibrary(path=config.key_directory, verbose=config.verbose)
+    library = open_key_library(config, verbose=config.verbose)
     library.add_keys()
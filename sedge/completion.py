@@ -0,0 +1,140 @@
+import mmap
+import os
+import struct
+from array import array
+from tempfile import NamedTemporaryFile
+
+
+class CompletionIndex:
+    """
+    a sorted list of host names, stored so that it can be memory-mapped and
+    searched by prefix without reading it all. the file is laid out as:
+
+      - a header: magic, version, and the number of names
+      - 257 offsets into the list of names: the first name beginning with
+        each byte value, and the end of the list
+      - for each name, its offset into the names; then the end of the names
+      - the names, UTF-8 encoded, sorted by their encoding, and each
+        followed by a newline
+
+    offsets are unsigned 32-bit integers, in native byte order.
+    """
+
+    magic = b"SEDGEHIX"
+    version = 1
+    header = struct.Struct("=8sII")
+
+    @classmethod
+    def write(cls, path, names):
+        """
+        atomically replace path with an index of names
+        """
+        encoded = sorted(set(t.encode("utf8") for t in names if t))
+        buckets = array("I")
+        offsets = array("I")
+        position = 0
+        for i, name in enumerate(encoded):
+            while len(buckets) <= name[0]:
+                buckets.append(i)
+            offsets.append(position)
+            position += len(name) + 1
+        offsets.append(position)
+        while len(buckets) <= 256:
+            buckets.append(len(encoded))
+
+        directory = os.path.dirname(path)
+        tmp_file = NamedTemporaryFile(mode="wb", dir=directory, delete=False)
+        try:
+            with tmp_file:
+                tmp_file.write(
+                    CompletionIndex.header.pack(
+                        CompletionIndex.magic, CompletionIndex.version, len(encoded)
+                    )
+                )
+                buckets.tofile(tmp_file)
+                offsets.tofile(tmp_file)
+                tmp_file.write(b"".join(t + b"\n" for t in encoded))
+            os.replace(tmp_file.name, path)
+        except Exception:
+            os.unlink(tmp_file.name)
+            raise
+
+    def __init__(self, path):
+        with open(path, "rb") as fd:
+            self._map = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        if not self._is_valid():
+            self.close()
+            raise ValueError("{} is not a host completion index".format(path))
+        view = self._view = memoryview(self._map)
+        start = CompletionIndex.header.size
+        end = start + 4 * 257
+        self._buckets = view[start:end].cast("I")
+        start, end = end, end + 4 * (self._count + 1)
+        self._offsets = view[start:end].cast("I")
+        self._names = end
+
+    def _is_valid(self):
+        """
+        check the header, and that the file is as long as it says: a
+        truncated or damaged index is treated like a missing one
+        """
+        size = len(self._map)
+        if size < CompletionIndex.header.size:
+            return False
+        magic, version, self._count = CompletionIndex.header.unpack_from(self._map)
+        if magic != CompletionIndex.magic or version != CompletionIndex.version:
+            return False
+        names = CompletionIndex.header.size + 4 * 257 + 4 * (self._count + 1)
+        if names > size:
+            return False
+        buckets = struct.unpack_from("=257I", self._map, CompletionIndex.header.size)
+        if max(buckets) > self._count:
+            return False
+        # the last offset is the end of the names
+        (end,) = struct.unpack_from("=I", self._map, names - 4)
+        return names + end <= size
+
+    def __len__(self):
+        return self._count
+
+    def _name(self, i):
+        start = self._names + self._offsets[i]
+        end = self._names + self._offsets[i + 1] - 1
+        return self._map[start:end]
+
+    def _bisect(self, lo, hi, before):
+        """
+        returns the first index in [lo, hi) for which before(name) is
+        false; the names for which it is true must all come first
+        """
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if before(self._name(mid)):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def complete(self, prefix):
+        """
+        returns the names which start with prefix, in sorted order
+        """
+        prefix = prefix.encode("utf8")
+        if prefix:
+            lo = self._buckets[prefix[0]]
+            hi = self._buckets[prefix[0] + 1]
+        else:
+            lo, hi = 0, self._count
+        first = self._bisect(lo, hi, lambda name: name < prefix)
+        end = self._bisect(first, hi, lambda name: name[: len(prefix)] == prefix)
+        if first == end:
+            return []
+        start = self._names + self._offsets[first]
+        end = self._names + self._offsets[end] - 1
+        return self._map[start:end].decode("utf8").split("\n")
+
+    def close(self):
+        for view in ("_buckets", "_offsets", "_view"):
+            if hasattr(self, view):
+                getattr(self, view).release()
+        self._map.close()
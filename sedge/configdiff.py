@@ -0,0 +1,70 @@
+import difflib
+import re
+from itertools import islice
+
+stanza_start = re.compile(r"^\s*(host|match)(\s|=)", re.IGNORECASE)
+
+
+def split_stanzas(lines):
+    """
+    split the lines of an ssh_config(5) file into stanzas, returning
+    {(header, n): lines} in file order. the lines before the first
+    Host or Match have the header None; n counts repeated headers.
+    trailing blank lines are dropped from each stanza.
+    """
+    stanzas = {}
+    seen = {}
+    current = []
+    key = (None, 0)
+    stanzas[key] = current
+    for line in lines:
+        if stanza_start.match(line):
+            header = line.strip()
+            n = seen.get(header, 0)
+            seen[header] = n + 1
+            key = (header, n)
+            current = stanzas[key] = []
+        current.append(line)
+    # the blank lines which separate stanzas aren't part of either
+    for lines in stanzas.values():
+        while lines and not lines[-1].strip():
+            lines.pop()
+    return stanzas
+
+
+def stanza_diff(a, b, max_lines=None):
+    """
+    compare two ssh_config(5) files, given as lists of lines. stanzas
+    are matched by their header, and only the stanzas whose bodies differ
+    are diffed line by line; a stanza which has moved is not reported.
+    yields the lines of a report, at most max_lines of them (if given)
+    """
+
+    def report():
+        before = split_stanzas(a)
+        after = split_stanzas(b)
+        removed = [t for t in before if t not in after]
+        added = [t for t in after if t not in before]
+        changed = [
+            t for t in after if t in before and "".join(after[t]) != "".join(before[t])
+        ]
+        yield "{} added, {} removed, {} changed\n".format(
+            len(added), len(removed), len(changed)
+        )
+        for header, _ in removed:
+            yield "removed: {}\n".format(header)
+        for header, _ in added:
+            yield "added: {}\n".format(header)
+        for key in changed:
+            header = key[0] if key[0] is not None else "(global configuration)"
+            yield "changed: {}\n".format(header)
+            diff = difflib.unified_diff(before[key], after[key], n=1)
+            # skip the ---/+++ file header lines
+            for line in islice(diff, 2, None):
+                yield line if line.endswith("\n") else line + "\n"
+
+    for i, line in enumerate(report()):
+        if max_lines is not None and i == max_lines:
+            yield "... (output truncated at {} lines)\n".format(max_lines)
+            return
+        yield line
@@ -1,15 +1,107 @@
+import fnmatch
+import hashlib
+import json
 import os
+import re
 import shlex
 import sys
+from bisect import bisect_right
+from collections.abc import Sequence
 from io import StringIO
-from itertools import product
+from itertools import accumulate, chain, islice
 
+from .completion import CompletionIndex
 from .exceptions import (
     ParserException,
     OutputException,
 )
+from . import sedge_version
 from .keylib import KeyNotFound
-from .urlhandling import get_contents
+from .parsecache import ParseCache
+from .timings import timings
+from .urlhandling import IncludeFetcher, make_session
+
+
+class IsCycle(Exception):
+    pass
+
+
+class Template:
+    """
+    a list of lines, pre-split into literal text and variable slots, so
+    that each set of variable values can be substituted in a single pass
+    """
+
+    def __init__(self, lines, substs):
+        # longest first, so that a variable which is a prefix of another
+        # doesn't steal its match
+        substs = sorted(substs, key=len, reverse=True)
+        slot_re = None
+        if substs:
+            slot_re = re.compile("|".join(re.escape(t) for t in substs))
+        self.lines = [Template.compile_line(t, slot_re) for t in lines]
+        self.n_slots = sum(
+            sum(1 for slot, _ in t if slot)
+            for t in self.lines
+            if not isinstance(t, str)
+        )
+
+    @classmethod
+    def compile_line(cls, line, slot_re):
+        """
+        returns a list of (is_slot, text) segments for the line, or
+        the line itself if it contains no variables
+        """
+        if slot_re is None:
+            return line
+        segments = []
+        pos = 0
+        for m in slot_re.finditer(line):
+            start = m.start()
+            if start > pos:
+                segments.append((False, line[pos:start]))
+            segments.append((True, m.group(0)))
+            pos = m.end()
+        if not segments:
+            return line
+        if pos < len(line):
+            segments.append((False, line[pos:]))
+        return segments
+
+    @classmethod
+    def resolve(cls, val_dict, names=None):
+        """
+        a value may refer to a variable after it in val_dict: an @set value
+        to a @with variable, or to a later @set. substituting each variable
+        in turn expanded these, so returns val_dict with the values of names
+        (default: all) expanded in the same way
+        """
+        keys = None
+        resolved = val_dict
+        for name in val_dict if names is None else names:
+            value = val_dict[name]
+            if "<" not in value:
+                continue
+            if keys is None:
+                keys = list(val_dict)
+                resolved = dict(val_dict)
+            for later in islice(keys, keys.index(name) + 1, None):
+                value = value.replace(later, val_dict[later])
+            resolved[name] = value
+        return resolved
+
+    def render(self, val_dict, expect_val=False):
+        timings.count("substitutions", self.n_slots)
+        for line in self.lines:
+            if isinstance(line, str):
+                if expect_val and line.startswith("<") and line.endswith(">"):
+                    raise ParserException(
+                        "expected a value for variable '%s', set it using @set or @args"
+                        % line
+                    )
+                yield line
+            else:
+                yield "".join(val_dict[t] if slot else t for slot, t in line)
 
 
 class Section:
@@ -19,6 +111,8 @@ class Section:
         self.lines = []
         self.types = []
         self.identities = []
+        # the line of the source at which the section is defined
+        self.lineno = None
 
     def has_lines(self):
         return len(self.lines) > 0
@@ -32,27 +126,39 @@ class Section:
     def add_identity(self, name):
         self.identities.append(name)
 
-    def get_lines(self, config_access, visited_set):
+    def get_own_lines(self, config_access):
         """
-        get the lines for this section
-        visited_set is used to avoid visiting same section
-        twice, if we've got a diamond in the @is setup
+        get the lines set directly within this section, including
+        those generated by @identity
         """
-        if self in visited_set:
-            return []
         lines = self.lines.copy()
-        visited_set.add(self)
         for identity in self.identities:
-            if config_access.get_keyfile(identity):
+            keyfile_path = config_access.get_keyfile(identity)
+            if keyfile_path:
                 lines.append(("IdentitiesOnly", ["yes"]))
-                keyfile_path = config_access.get_keyfile(identity)
                 # shlex.quote() style shell escaping doens't work here, we are limited to double-quotes
-                lines.append(
-                    ("IdentityFile", ['"' + config_access.get_keyfile(identity) + '"'])
-                )
-        for section_name in self.types:
-            section = config_access.get_section(section_name)
-            lines += section.get_lines(config_access, visited_set)
+                lines.append(("IdentityFile", ['"' + keyfile_path + '"']))
+        return lines
+
+    def get_lines(self, config_access):
+        """
+        get the lines for this section and every section it inherits
+        from via @is. each section contributes its lines only once, even
+        if we've got a diamond in the @is setup
+        """
+        linearized = config_access.linearize(self)
+        inherited = [
+            config_access.linearize(config_access.get_section(t)) for t in self.types
+        ]
+        lines = list(config_access.get_own_lines(self))
+        if len(linearized) == 1 + sum(len(t) for t in inherited):
+            # no section is shared between our @is types, so their cached
+            # lines can be used as-is
+            for section in (t[0] for t in inherited):
+                lines += config_access.get_inherited_lines(section)
+        else:
+            for section in linearized[1:]:
+                lines += config_access.get_own_lines(section)
         return lines
 
     def __repr__(self):
@@ -98,12 +204,116 @@ class HostAttrs(Section):
         super(HostAttrs, self).__init__(name, [])
 
 
+class LazySequence(Sequence):
+    """
+    a sequence which compares equal to any other with the same items
+    """
+
+    def __eq__(self, other):
+        if not isinstance(other, Sequence) or isinstance(other, str):
+            return NotImplemented
+        return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+    def __repr__(self):
+        return "<{} of {} values>".format(type(self).__name__, len(self))
+
+
+class WithRange(LazySequence):
+    """
+    the values of a @with range, formatted only as they are accessed
+    """
+
+    def __init__(self, values, width):
+        self._values = values
+        self._width = width
+
+    def _format(self, value):
+        if self._width is not None:
+            return "%0*d" % (self._width, value)
+        return str(value)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return WithRange(self._values[index], self._width)
+        return self._format(self._values[index])
+
+    def __iter__(self):
+        return map(self._format, self._values)
+
+    def __contains__(self, value):
+        try:
+            number = int(value)
+        except (TypeError, ValueError):
+            return False
+        return number in self._values and self._format(number) == value
+
+
+class WithValues(LazySequence):
+    """
+    the values of a @with definition: the concatenation of the values of
+    each of its tokens
+    """
+
+    def __init__(self, parts):
+        self._parts = [t for t in parts if len(t)]
+        self._ends = list(accumulate(len(t) for t in self._parts))
+
+    def __len__(self):
+        return self._ends[-1] if self._ends else 0
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[t] for t in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("@with value index out of range")
+        part = bisect_right(self._ends, index)
+        start = self._ends[part - 1] if part else 0
+        return self._parts[part][index - start]
+
+    def __iter__(self):
+        return chain.from_iterable(self._parts)
+
+    def __contains__(self, value):
+        return any(value in t for t in self._parts)
+
+
+def lazy_product(sequences):
+    """
+    as itertools.product, but without first copying each sequence, as
+    the values of a @with may be far too many to hold in memory
+    """
+    if not sequences:
+        yield ()
+        return
+    first, rest = sequences[0], sequences[1:]
+    if not rest:
+        for value in first:
+            yield (value,)
+        return
+    for value in first:
+        for tail in lazy_product(rest):
+            yield (value,) + tail
+
+
 class Host(Section):
+    # the number of stanzas rendered by estimate()
+    estimate_samples = 16
+
     @classmethod
-    def expand_with_token(cls, s):
+    def parse_range(cls, s):
+        """
+        returns (range, width) for a range token "{A..B}" or "{A..B/C}",
+        where width is the zero-padded width of its values (or None if
+        they aren't padded), or None if s is not a range
+        """
         fmt_error = "range should be format {A..B} or {A..B/C}"
         if not s.startswith("{") or not s.endswith("}"):
-            return [s]
+            return None
         try:
             range_defn = s[1:-1]
             incr = 1
@@ -119,73 +329,190 @@ class Host(Section):
             to_width = len("%0s" % range_parts[1])
         except ValueError:
             raise ParserException("expected an integer in range definition.")
-        if from_width == to_width:
-            return ["%0*d" % (to_width, t) for t in range(from_val, to_val, incr)]
-        else:
-            return list(str(t) for t in range(from_val, to_val, incr))
+        width = to_width if from_width == to_width else None
+        return range(from_val, to_val, incr), width
+
+    @classmethod
+    def expand_with_token(cls, s):
+        parsed = Host.parse_range(s)
+        if parsed is None:
+            return [s]
+        return WithRange(*parsed)
 
     @classmethod
     def expand_with(cls, defn):
-        expanded = []
-        for tok in defn:
-            expanded += Host.expand_with_token(tok)
-        return expanded
+        return WithValues([Host.expand_with_token(tok) for tok in defn])
+
+    def solve(self, hostname, base):
+        """
+        yields a dict of substitutions for each stanza this Host would
+        output for hostname. the name is matched against the template,
+        each @with variable being checked against its definition, so
+        that large @with products needn't be expanded; wildcards in the
+        name match as they would for ssh.
+        """
+        base_substs, deferred = Host.base_substs(base)
+        with_defns = dict(
+            ("<" + with_defn[0] + ">", Host.expand_with(with_defn[1:]))
+            for with_defn in self.with_exprs
+        )
+        deferred += list(with_defns)
+        # the base variables are substituted first, as their values may
+        # refer to @with variables
+        name = next(Template([self.name], base_substs).render(base_substs))
+        name = Template([name], with_defns).lines[0]
+        if isinstance(name, str):
+            segments = [(False, name)]
+        else:
+            segments = name
+
+        def match(pos, index, bound):
+            if index == len(segments):
+                if pos == len(hostname):
+                    yield dict(bound)
+                return
+            is_var, text = segments[index]
+            if not is_var and any(c in text for c in "*?"):
+                # part of a pattern, which ssh will apply to any host
+                # matching it
+                for end in range(pos, len(hostname) + 1):
+                    if fnmatch.fnmatchcase(hostname[pos:end], text):
+                        yield from match(end, index + 1, bound)
+                return
+            if not is_var:
+                if hostname.startswith(text, pos):
+                    yield from match(pos + len(text), index + 1, bound)
+                return
+            if text in bound:
+                if hostname.startswith(bound[text], pos):
+                    yield from match(pos + len(bound[text]), index + 1, bound)
+                return
+            for end in range(pos + 1, len(hostname) + 1):
+                value = hostname[pos:end]
+                if value in with_defns[text]:
+                    bound[text] = value
+                    yield from match(end, index + 1, bound)
+                    del bound[text]
+
+        for bound in match(0, 0, {}):
+            # @with variables not used in the name give a stanza per value
+            unbound = [t for t in with_defns if t not in bound]
+            for val_tpl in lazy_product([with_defns[t] for t in unbound]):
+                val_dict = base_substs.copy()
+                val_dict.update(bound)
+                val_dict.update(zip(unbound, val_tpl))
+                yield Template.resolve(val_dict, deferred)
 
     def resolve_defn(self, config_access):
-        visited = set()
         # we shove the name in here, then on the other end of the substitution
         # logic we can get it back out. FIXME clean this up.
         lines = [self.name]
-        for keyword, parts in self.get_lines(config_access, visited):
+        for keyword, parts in self.get_lines(config_access):
             lines.append(ConfigOutput.to_line(keyword, parts, indent=4))
         return lines
 
-    def apply_substitutions(self, lines, val_dict, expect_val=False):
-        for line in lines:
-            original_line = line
-            for subst, value in val_dict.items():
-                line = line.replace(subst, value)
-            if (
-                original_line
-                and expect_val
-                and line == original_line
-                and line.startswith("<")
-                and line.endswith(">")
-            ):
-                raise ParserException(
-                    "expected a value for variable '%s', set it using @set or @args"
-                    % original_line
-                )
-            yield line
+    def substs(self, base):
+        """
+        returns the names of all variables which may be substituted
+        into this stanza, in their <name> form
+        """
+        names = set("<" + t + ">" for t in base)
+        names.update("<" + with_defn[0] + ">" for with_defn in self.with_exprs)
+        return names
+
+    @classmethod
+    def base_substs(cls, base):
+        """
+        returns the substitutions for the variables in base, with references
+        from one to another resolved, and the names of those which may still
+        refer to a @with variable
+        """
+        base_substs = Template.resolve(
+            dict(("<" + t + ">", u) for (t, u) in base.items())
+        )
+        return base_substs, [t for t, u in base_substs.items() if "<" in u]
 
     def variable_iter(self, base):
         """
         returns iterator over the cross product of the variables
         for this stanza
         """
-        base_substs = dict(("<" + t + ">", u) for (t, u) in base.items())
+        base_substs, deferred = Host.base_substs(base)
         substs = []
         vals = []
         for with_defn in self.with_exprs:
             substs.append("<" + with_defn[0] + ">")
             vals.append(Host.expand_with(with_defn[1:]))
-        for val_tpl in product(*vals):
+        deferred += substs
+        for val_tpl in lazy_product(vals):
             r = base_substs.copy()
             r.update(dict(zip(substs, val_tpl)))
-            yield r
+            yield Template.resolve(r, deferred)
 
     def host_stanzas(self, config_access):
         """
         returns a list of host definitions
         """
-        defn_lines = self.resolve_defn(config_access)
-        for val_dict in self.variable_iter(config_access.get_variables()):
-            subst = list(
-                self.apply_substitutions(defn_lines, val_dict, expect_val=True)
-            )
-            host = subst[0]
-            lines = [ConfigOutput.to_line("Host", [host])] + subst[1:]
-            yield host, lines
+        base = config_access.get_variables()
+        template = Template(self.resolve_defn(config_access), self.substs(base))
+        for val_dict in self.variable_iter(base):
+            yield Host.stanza(template, val_dict)
+
+    def host_stanzas_for(self, config_access, hostname):
+        """
+        as host_stanzas(), but only those for hostname
+        """
+        base = config_access.get_variables()
+        template = None
+        for val_dict in self.solve(hostname, base):
+            if template is None:
+                template = Template(self.resolve_defn(config_access), self.substs(base))
+            yield Host.stanza(template, val_dict)
+
+    def estimate(self, config_access):
+        """
+        returns (hosts, lines, bytes): the number of host stanzas this Host
+        will output, and an estimate of their size in the output, made by
+        rendering a sample of them spread across the @with product
+        """
+        base = config_access.get_variables()
+        base_substs, deferred = Host.base_substs(base)
+        substs = []
+        vals = []
+        for with_defn in self.with_exprs:
+            substs.append("<" + with_defn[0] + ">")
+            vals.append(Host.expand_with(with_defn[1:]))
+        deferred += substs
+        hosts = 1
+        for values in vals:
+            hosts *= len(values)
+        if hosts == 0:
+            return 0, 0, 0
+        template = Template(self.resolve_defn(config_access), self.substs(base))
+        n_samples = min(hosts, Host.estimate_samples)
+        lines = size = 0
+        for sample in range(n_samples):
+            # decompose an index into the product into an index per @with
+            index = sample * (hosts - 1) // max(1, n_samples - 1)
+            val_tpl = []
+            for values in reversed(vals):
+                index, value_index = divmod(index, len(values))
+                val_tpl.insert(0, values[value_index])
+            val_dict = base_substs.copy()
+            val_dict.update(zip(substs, val_tpl))
+            _, stanza = Host.stanza(template, Template.resolve(val_dict, deferred))
+            lines += len(stanza)
+            # each line, and the blank line between stanzas
+            size += sum(len(t) + 1 for t in stanza) + 1
+        return hosts, hosts * lines // n_samples, hosts * size // n_samples
+
+    @classmethod
+    def stanza(cls, template, val_dict):
+        subst = list(template.render(val_dict, expect_val=True))
+        host = subst[0]
+        lines = [ConfigOutput.to_line("Host", [host])] + subst[1:]
+        timings.count("stanzas")
+        return host, lines
 
 
 class SectionConfigAccess:
@@ -200,24 +527,17 @@ class SectionConfigAccess:
     def get_section(self, name):
         return self._config._get_section_by_name(name)
 
+    def linearize(self, section):
+        return self._config._linearize(section)
+
+    def get_own_lines(self, section):
+        return self._config._get_own_lines(section)
+
+    def get_inherited_lines(self, section):
+        return self._config._get_inherited_lines(section)
+
     def get_keyfile(self, name):
-        try:
-            fingerprints = self._config.keydefs[name]
-        except KeyError:
-            self._config.warn(
-                "identity '{}' is not defined (missing @key definition)".format(name)
-            )
-            return None
-        for fingerprint in fingerprints:
-            try:
-                return self._config._key_library.lookup(fingerprint)
-            except KeyNotFound:
-                pass
-        self._config.warn(
-            "identity '{name}' (fingerprints {fingerprints}) not found in SSH key library".format(
-                name=name, fingerprints="; ".join(fingerprints)
-            )
-        )
+        return self._config.keyfiles.get(name)
 
     def get_variables(self):
         return self._config.sections[0].get_variables()
@@ -269,18 +589,69 @@ class SedgeEngine:
         args=None,
         parent_keydefs=None,
         via_include=False,
+        fetcher=None,
+        include_cache=None,
+        parse_cache=None,
+        session=None,
+        included_from=None,
     ):
         self._key_library = key_library
         self._url = url
         self._args = args
         self._verify_ssl = verify_ssl
         self._via_include = via_include
+        # the root section holds the global config; it has no name of its
+        # own, so isn't indexed
         self.sections = [Root()]
+        self._sections_by_name = {}
+        self._ambiguous_names = set()
         self.includes = []
+        # (url, args) of every @include parsed in this run, mapped to the
+        # file which first included it
+        self._included_from = included_from if included_from is not None else {}
+        self._include_keys = []
+        self._include_cache = include_cache
+        self._parse_cache = parse_cache
+        self._include_directives = []
+        self._parent_keydefs = dict(parent_keydefs or {})
+        self._linearized = {}
+        self._own_lines = {}
+        self._inherited_lines = {}
         self.keydefs = {}
+        self.keyfiles = {}
         if parent_keydefs is not None:
             self.keydefs.update(parent_keydefs)
-        self.parse(fd)
+        self.failed_includes = []
+        lines = list(fd)
+        self.source_digest = SedgeEngine.digest("".join(lines))
+        if fetcher is None:
+            # the top-level engine owns the HTTP session and the fetcher,
+            # and shares them with every engine created for an @include
+            self._session = make_session()
+            fetcher = IncludeFetcher(
+                verify_ssl,
+                SedgeEngine.find_includes,
+                cache=include_cache,
+                session=self._session,
+            )
+            fetcher.prefetch(lines)
+            try:
+                self._fetcher = fetcher
+                self.parse_cached(lines)
+            finally:
+                fetcher.close()
+                self._session.close()
+        else:
+            self._session = session
+            self._fetcher = fetcher
+            self.parse_cached(lines)
+        if not self.is_include():
+            with timings.phase("identities"):
+                self.resolve_identities()
+
+    @classmethod
+    def digest(cls, text):
+        return hashlib.sha256(text.encode("utf8")).hexdigest()
 
     def warn(self, message):
         print("{url}: {msg}".format(url=self._url, msg=message), file=sys.stderr)
@@ -340,6 +711,26 @@ class SedgeEngine:
                 other = line_parts[1].strip()
             return line_parts[0], SedgeEngine.parse_other_space(other)
 
+    @classmethod
+    def find_includes(cls, text):
+        """
+        returns the targets of the @include lines in text (a string, or
+        an iterable of lines), without otherwise parsing it
+        """
+        if isinstance(text, str):
+            text = text.splitlines()
+        targets = []
+        for line in (t.strip() for t in text):
+            if not line.startswith("@include"):
+                continue
+            try:
+                keyword, parts = SedgeEngine.parse_config_line(line)
+            except ParserException:
+                continue
+            if keyword == "@include" and parts:
+                targets.append(parts[0])
+        return targets
+
     def is_include(self):
         return self._via_include
 
@@ -347,29 +738,12 @@ class SedgeEngine:
         """very simple parser - but why would we want it to be complex?"""
 
         def resolve_args(args, expect_val=False):
-            # FIXME break this out, it's in common with the templating stuff elsewhere
             root = self.sections[0]
             val_dict = dict(
                 ("<" + t + ">", u) for (t, u) in root.get_variables().items()
             )
-            resolved_args = []
-            for arg in args:
-                original_arg = arg
-                for subst, value in val_dict.items():
-                    arg = arg.replace(subst, value)
-                if (
-                    original_arg
-                    and expect_val
-                    and arg == original_arg
-                    and arg.startswith("<")
-                    and arg.endswith(">")
-                ):
-                    raise ParserException(
-                        "expected a value for variable '%s', set it using @set or @args"
-                        % original_arg
-                    )
-                resolved_args.append(arg)
-            return resolved_args
+            template = Template(args, val_dict.keys())
+            return list(template.render(val_dict, expect_val=expect_val))
 
         def handle_section_defn(keyword, parts):
             if keyword == "@HostAttrs":
@@ -377,14 +751,12 @@ class SedgeEngine:
                     raise ParserException("usage: @HostAttrs <hostname>")
                 if self.sections[0].has_pending_with():
                     raise ParserException("@with not supported with @HostAttrs")
-                self.sections.append(HostAttrs(parts[0]))
+                self.add_section(HostAttrs(parts[0]))
                 return True
             if keyword == "Host":
                 if len(parts) != 1:
                     raise ParserException("usage: Host <hostname>")
-                self.sections.append(
-                    Host(parts[0], self.sections[0].pop_pending_with())
-                )
+                self.add_section(Host(parts[0], self.sections[0].pop_pending_with()))
                 return True
 
         def handle_vardef(root, keyword, parts):
@@ -436,23 +808,10 @@ class SedgeEngine:
                 raise ParserException(
                     "usage: @include <https://...|/path/to/file.sedge> [arg ...]"
                 )
-            url = parts[0]
-            subargs = parts[1:]
-            try:
-                contents = get_contents(url, self._verify_ssl)
-            except Exception as e:
-                print("skipping `@import {}': {}".format(" ".join(parts), repr(e)))
-                return
-            subconfig = SedgeEngine(
-                self._key_library,
-                StringIO(contents),
-                self._verify_ssl,
-                url=url,
-                args=resolve_args(subargs, expect_val=True),
-                parent_keydefs=self.keydefs,
-                via_include=True,
-            )
-            self.includes.append((url, subconfig))
+            subargs = resolve_args(parts[1:], expect_val=True)
+            directive = (parts, subargs, dict(self.keydefs))
+            self._include_directives.append(directive)
+            self.include(*directive)
 
         def handle_keydef(_, parts):
             if len(parts) < 2:
@@ -475,11 +834,12 @@ class SedgeEngine:
                 handlers[keyword](section, parts)
                 return True
 
-        for line in (t.strip() for t in fd):
+        for lineno, line in enumerate((t.strip() for t in fd), 1):
             if line.startswith("#") or line == "":
                 continue
             keyword, parts = SedgeEngine.parse_config_line(line)
             if handle_section_defn(keyword, parts):
+                self.sections[-1].lineno = lineno
                 continue
             if handle_vardef(self.sections[0], keyword, parts):
                 continue
@@ -493,53 +853,324 @@ class SedgeEngine:
             # need to
             current_section.add_line(keyword, parts)
 
+    def include(self, parts, subargs, keydefs):
+        """
+        handle an @include of parts[0], given its resolved arguments and
+        our key definitions at the point of the @include
+        """
+        url = parts[0]
+        include_key = (url, tuple(subargs))
+        if include_key in self._included_from:
+            self.warn(
+                "duplicate @include '{target}' ignored, already included from '{first}'".format(
+                    target=" ".join((url,) + include_key[1]),
+                    first=self._included_from[include_key],
+                )
+            )
+            return
+        try:
+            contents = self._fetcher.get_contents(url)
+        except Exception as e:
+            print("skipping `@import {}': {}".format(" ".join(parts), repr(e)))
+            self.failed_includes.append(url)
+            return
+        # recorded before parsing, so that an include cycle is caught
+        # as a duplicate rather than recursing
+        self._included_from[include_key] = self._url
+        self._include_keys.append(include_key)
+        subconfig = SedgeEngine(
+            self._key_library,
+            StringIO(contents),
+            self._verify_ssl,
+            url=url,
+            args=subargs,
+            parent_keydefs=keydefs,
+            via_include=True,
+            fetcher=self._fetcher,
+            session=self._session,
+            include_cache=self._include_cache,
+            parse_cache=self._parse_cache,
+            included_from=self._included_from,
+        )
+        self.includes.append((url, subconfig))
+
+    def _parse_key(self, lines):
+        """
+        parsing is a pure function of these inputs; their hash is the key
+        for the parsed state in the parse cache
+        """
+        inputs = [
+            sedge_version(),
+            "".join(lines),
+            self._args,
+            self._parent_keydefs,
+            self._via_include,
+        ]
+        return SedgeEngine.digest(json.dumps(inputs, sort_keys=True))
+
+    def parse_cached(self, lines):
+        """
+        as parse(), but restoring the parsed state from the parse cache if
+        these lines have been parsed before. the @include directives are
+        then carried out, as they would have been during parsing.
+        """
+        if self._parse_cache is None or len(lines) < ParseCache.min_lines:
+            self.parse(lines)
+            return
+        key = self._parse_key(lines)
+        state = self._parse_cache.get(key)
+        if state is None:
+            self.parse(lines)
+            self._parse_cache.store(
+                key,
+                {
+                    "sections": self.sections,
+                    "sections_by_name": self._sections_by_name,
+                    "ambiguous_names": self._ambiguous_names,
+                    "keydefs": self.keydefs,
+                    "include_directives": self._include_directives,
+                },
+            )
+            return
+        self.sections = state["sections"]
+        self._sections_by_name = state["sections_by_name"]
+        self._ambiguous_names = state["ambiguous_names"]
+        self.keydefs = state["keydefs"]
+        self._include_directives = state["include_directives"]
+        for directive in self._include_directives:
+            self.include(*directive)
+
     def sections_for_cls(self, cls):
         return (t for t in self.sections if isinstance(t, cls))
 
+    def add_section(self, section):
+        """
+        add a section, indexing it by name for @is lookups. @HostAttrs names
+        must be unique; duplicate Host names are permitted (and warned about
+        on output), but can't then be referenced with @is
+        """
+        existing = self._sections_by_name.get(section.name)
+        if existing is not None:
+            if isinstance(section, HostAttrs) or isinstance(existing, HostAttrs):
+                raise ParserException(
+                    "More than one section with name '{}'".format(section.name)
+                )
+            self._ambiguous_names.add(section.name)
+        else:
+            self._sections_by_name[section.name] = section
+        self.sections.append(section)
+
     def _get_section_by_name(self, name):
-        matches = [t for t in self.sections if t.name == name]
-        if len(matches) > 1:
+        if name in self._ambiguous_names:
             raise ParserException("More than one section with name '{}'".format(name))
-        if len(matches) == 0:
+        try:
+            return self._sections_by_name[name]
+        except KeyError:
             raise ParserException("No such section: {}".format(name))
-        return matches[0]
+
+    def engines(self):
+        """
+        yields this engine, then every engine created for an @include
+        beneath it, in output order
+        """
+        yield self
+        for url, subconfig in self.includes:
+            yield from subconfig.engines()
+
+    def reload_include(self, index, contents):
+        """
+        replace the engine for our index'th @include with one parsed from
+        contents, leaving the rest of the tree as it is. returns the new
+        engine; call refresh_identities() on the top-level engine after.
+        """
+        url, old = self.includes[index]
+        # the old subtree's includes may be included again by the new one
+        for engine in old.engines():
+            for include_key in engine._include_keys:
+                self._included_from.pop(include_key, None)
+        subconfig = SedgeEngine(
+            self._key_library,
+            StringIO(contents),
+            self._verify_ssl,
+            url=url,
+            args=old._args,
+            parent_keydefs=old._parent_keydefs,
+            via_include=True,
+            include_cache=self._include_cache,
+            parse_cache=self._parse_cache,
+            included_from=self._included_from,
+        )
+        self.includes[index] = (url, subconfig)
+        return subconfig
+
+    def refresh_identities(self):
+        """
+        forget the key files resolved for every @identity in this tree,
+        and resolve them again against the key library
+        """
+        for engine in self.engines():
+            engine.keyfiles = {}
+            engine._own_lines = {}
+            engine._inherited_lines = {}
+        self.resolve_identities()
+
+    def key_fingerprints(self):
+        """
+        returns the sorted fingerprints of every @key definition used by
+        an @identity in this engine or its includes
+        """
+        wanted = set()
+        for engine in self.engines():
+            for section in engine.sections:
+                for name in section.identities:
+                    wanted.update(engine.keydefs.get(name, ()))
+        return sorted(wanted)
+
+    def sources(self):
+        """
+        returns [url, digest] for the text parsed by this engine and each
+        of its includes, and [url, None] for includes which couldn't be
+        fetched
+        """
+        sources = []
+        for engine in self.engines():
+            sources.append([engine._url, engine.source_digest])
+            sources += [[t, None] for t in engine.failed_includes]
+        return sources
+
+    def resolve_identities(self, resolved=None):
+        """
+        resolve each @identity used in this engine and its includes to a
+        key file. identities with the same key definition are looked up in
+        the key library, and warned about if missing, only once.
+        """
+        if resolved is None:
+            resolved = {}
+            # scan the key library just once for everything we'll need
+            wanted = self.key_fingerprints()
+            if wanted:
+                self._key_library.require(wanted)
+        for section in self.sections:
+            for name in section.identities:
+                if name in self.keyfiles:
+                    continue
+                fingerprints = self.keydefs.get(name)
+                if fingerprints is not None:
+                    fingerprints = tuple(fingerprints)
+                key = (name, fingerprints)
+                if key not in resolved:
+                    resolved[key] = self._lookup_identity(name, fingerprints)
+                self.keyfiles[name] = resolved[key]
+        for url, subconfig in self.includes:
+            subconfig.resolve_identities(resolved)
+
+    def _lookup_identity(self, name, fingerprints):
+        if fingerprints is None:
+            self.warn(
+                "identity '{}' is not defined (missing @key definition)".format(name)
+            )
+            return None
+        for fingerprint in fingerprints:
+            try:
+                return self._key_library.lookup(fingerprint)
+            except KeyNotFound:
+                pass
+        self.warn(
+            "identity '{name}' (fingerprints {fingerprints}) not found in SSH key library".format(
+                name=name, fingerprints="; ".join(fingerprints)
+            )
+        )
+
+    def _linearize(self, section):
+        """
+        returns a tuple of this section followed by every section it
+        inherits from via @is, in depth-first order, each section appearing
+        once. results are cached; in an acyclic @is graph, a section's
+        linearization is itself followed by its @is types' linearizations,
+        skipping any section already present.
+        """
+
+        def merge(section, stack):
+            cached = self._linearized.get(section)
+            if cached is not None:
+                return cached
+            if section in stack:
+                raise IsCycle()
+            stack.add(section)
+            order = [section]
+            seen = {section}
+            for name in section.types:
+                for inherited in merge(self._get_section_by_name(name), stack):
+                    if inherited not in seen:
+                        seen.add(inherited)
+                        order.append(inherited)
+            stack.remove(section)
+            self._linearized[section] = tuple(order)
+            return self._linearized[section]
+
+        def walk(section, order):
+            # the uncached depth-first walk, only needed for @is cycles
+            if section in order:
+                return
+            order[section] = True
+            for name in section.types:
+                walk(self._get_section_by_name(name), order)
+
+        try:
+            return merge(section, set())
+        except IsCycle:
+            order = {}
+            walk(section, order)
+            return tuple(order)
+
+    def _get_own_lines(self, section):
+        if section not in self._own_lines:
+            self._own_lines[section] = section.get_own_lines(SectionConfigAccess(self))
+        return self._own_lines[section]
+
+    def _get_inherited_lines(self, section):
+        if section not in self._inherited_lines:
+            self._inherited_lines[section] = section.get_lines(
+                SectionConfigAccess(self)
+            )
+        return self._inherited_lines[section]
 
     def host_stanzas(self):
         for host in self.sections_for_cls(Host):
             for tpl in host.host_stanzas(SectionConfigAccess(self)):
                 yield tpl
 
-    def output(self, out, stanza_names=None):
-        # output global config from root section
+    def warn_ignored_globals(self):
+        """
+        global config is only output from the top-level configuration; warn
+        about any in an @include
+        """
         root = self.sections[0]
-        if self.is_include():
-            if root.has_lines():
-                print(
-                    "Warning: global config in @include '{url}' ignored.".format(
-                        url=self._url
-                    ),
-                    file=sys.stderr,
-                )
-                print("Ignored lines are:", file=sys.stderr)
-                warning_fd = StringIO()
-                warning_out = ConfigOutput(warning_fd)
-                warning_out.write_stanza(root.output_lines())
-                print(
-                    "\n".join([" > " + t for t in warning_fd.getvalue().splitlines()]),
-                    file=sys.stderr,
-                )
-        else:
-            out.write_stanza(root.output_lines())
-
-        if stanza_names is None:
-            stanza_names = set()
+        if not self.is_include() or not root.has_lines():
+            return
+        print(
+            "Warning: global config in @include '{url}' ignored.".format(url=self._url),
+            file=sys.stderr,
+        )
+        print("Ignored lines are:", file=sys.stderr)
+        warning_fd = StringIO()
+        warning_out = ConfigOutput(warning_fd)
+        warning_out.write_stanza(root.output_lines())
+        print(
+            "\n".join([" > " + t for t in warning_fd.getvalue().splitlines()]),
+            file=sys.stderr,
+        )
 
+    def check_duplicates(self, hostnames, stanza_names):
+        """
+        add hostnames, which this engine outputs, to stanza_names, warning
+        about any which have already been output
+        """
         dupes = set()
-        for hostname, stanza in self.host_stanzas():
+        for hostname in hostnames:
             if hostname in stanza_names:
                 dupes.add(hostname)
             stanza_names.add(hostname)
-            out.write_stanza(stanza)
         if dupes:
             print(
                 "Warning: duplicated hosts parsing '{url}'".format(url=self._url),
@@ -547,18 +1178,72 @@ class SedgeEngine:
             )
             print("  %s" % (", ".join(sorted(dupes))), file=sys.stderr)
 
+    def output_own(self, out, stanza_names):
+        """
+        output the global config and host stanzas of this engine, but not
+        of its includes. returns the names of the hosts output.
+        """
+        if self.is_include():
+            self.warn_ignored_globals()
+        else:
+            out.write_stanza(self.sections[0].output_lines())
+
+        hostnames = []
+        for hostname, stanza in self.host_stanzas():
+            hostnames.append(hostname)
+            out.write_stanza(stanza)
+        self.check_duplicates(hostnames, stanza_names)
+        return hostnames
+
+    def query(self, hostname):
+        """
+        yields (url, line number, stanza lines) for each stanza in this
+        tree which would be output for hostname, in output order
+        """
+        for engine in self.engines():
+            config_access = SectionConfigAccess(engine)
+            for host in engine.sections_for_cls(Host):
+                for _, lines in host.host_stanzas_for(config_access, hostname):
+                    yield engine._url, host.lineno, lines
+
+    def plan(self):
+        """
+        yields (url, Host, (hosts, lines, bytes)) for each Host in this
+        tree, in output order, without expanding them; see Host.estimate
+        """
+        for engine in self.engines():
+            config_access = SectionConfigAccess(engine)
+            for host in engine.sections_for_cls(Host):
+                yield engine._url, host, host.estimate(config_access)
+
+    def output(self, out, stanza_names=None):
+        if stanza_names is None:
+            stanza_names = set()
+
+        self.output_own(out, stanza_names)
         for url, subconfig in self.includes:
             subconfig.output(out, stanza_names)
 
-        # write out a list of hosts for completion use
         if not self.is_include():
-            outf = os.path.expanduser("~/.sedge/hosts")
-            pattern_characters = (",", "!", "*", "?")
-            try:
-                with open(outf, "w") as fd:
-                    for host in sorted(stanza_names):
-                        if any(host.find(c) != -1 for c in pattern_characters):
-                            continue
-                        print(host, file=fd)
-            except IOError:
-                print("warning: ~/.sedge/hosts could not be written.", file=sys.stderr)
+            SedgeEngine.write_hosts(stanza_names)
+
+    @classmethod
+    def write_hosts(cls, stanza_names):
+        """
+        write out a list of hosts for completion use, both as text and as
+        an index for `sedge complete`
+        """
+        outf = os.path.expanduser("~/.sedge/hosts")
+        pattern_characters = (",", "!", "*", "?")
+        hosts = [
+            host
+            for host in sorted(stanza_names)
+            if not any(host.find(c) != -1 for c in pattern_characters)
+        ]
+        try:
+            with open(outf, "w") as fd:
+                for host in hosts:
+                    print(host, file=fd)
+            CompletionIndex.write(outf + ".idx", hosts)
+        except IOError:
+            print("warning: ~/.sedge/hosts could not be written.", file=sys.stderr)
@@ -0,0 +1,174 @@
+import json
+import os
+import re
+from tempfile import NamedTemporaryFile
+
+from . import sedge_version
+from .engine import ConfigOutput, SedgeEngine
+from .manifest import output_stamp
+
+
+class FragmentWriter:
+    """
+    writes the output of each SedgeEngine in a tree (the configuration
+    file and each of its includes) to its own fragment file in
+    `directory`, and the output file as a list of OpenSSH `Include`s of
+    those fragments. a fragment is only regenerated when the inputs to its
+    engine have changed since it was written, or the file has been touched.
+    """
+
+    version = 1
+    state_name = ".sedge-fragments.json"
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._state_path = os.path.join(directory, FragmentWriter.state_name)
+
+    @classmethod
+    def fragment_name(cls, engine):
+        if not engine.is_include():
+            return "root.conf"
+        key = SedgeEngine.digest(json.dumps([engine._url, engine._args]))
+        base = os.path.basename(engine._url.rstrip("/"))
+        base = re.sub(r"\.sedge$", "", base)
+        base = re.sub(r"[^A-Za-z0-9_.-]", "_", base) or "include"
+        return "{}-{}.conf".format(base, key[:12])
+
+    @classmethod
+    def include_line(cls, path):
+        if " " in path:
+            path = '"{}"'.format(path)
+        return ConfigOutput.to_line("Include", [path])
+
+    @classmethod
+    def inputs_digest(cls, engine):
+        """
+        the output of an engine (other than its includes) depends only on
+        these
+        """
+        inputs = [
+            FragmentWriter.version,
+            sedge_version(),
+            engine._url,
+            engine.is_include(),
+            engine._args,
+            engine._parent_keydefs,
+            engine.source_digest,
+            engine.keyfiles,
+        ]
+        return SedgeEngine.digest(json.dumps(inputs, sort_keys=True))
+
+    def _load(self):
+        try:
+            with open(self._state_path) as fd:
+                state = json.load(fd)
+        except (OSError, ValueError):
+            return {}
+        if state.get("version") != FragmentWriter.version:
+            return {}
+        return state["fragments"]
+
+    def _save(self, fragments):
+        tmp_path = self._state_path + ".tmp"
+        try:
+            with open(tmp_path, "w") as fd:
+                json.dump(
+                    {"version": FragmentWriter.version, "fragments": fragments}, fd
+                )
+            os.replace(tmp_path, self._state_path)
+        except OSError:
+            pass
+
+    @classmethod
+    def _render(cls, path, write):
+        """
+        returns (temporary file, result of write(fd)) for the new contents
+        of path, written alongside it
+        """
+        tmp_file = NamedTemporaryFile(
+            mode="w", dir=os.path.dirname(path), prefix=".sedge-", delete=False
+        )
+        try:
+            result = write(tmp_file.file)
+            tmp_file.close()
+        except Exception:
+            tmp_file.close()
+            os.unlink(tmp_file.name)
+            raise
+        return tmp_file.name, result
+
+    @classmethod
+    def _is_current(cls, entry, digest, path):
+        if entry is None or entry["digest"] != digest:
+            return False
+        return entry["stamp"] == output_stamp(path)
+
+    def write(self, engine, output_file, header, on_replace=None):
+        """
+        write the fragments for engine's tree, and output_file including
+        them. on_replace(path, new_path), if given, is called before each
+        file is replaced. returns the paths of the files which make up the
+        output.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        previous = self._load()
+        fragments = {}
+        stanza_names = set()
+        # every fragment is rendered before any is replaced, so that an
+        # error leaves the previous output as it was
+        pending = []
+        try:
+            for subconfig in engine.engines():
+                name = FragmentWriter.fragment_name(subconfig)
+                path = os.path.join(self.directory, name)
+                digest = FragmentWriter.inputs_digest(subconfig)
+                entry = previous.get(name)
+                if self._is_current(entry, digest, path):
+                    # the fragment is as we left it; there's no need to render
+                    # it again, but its hosts may still clash with another's
+                    subconfig.warn_ignored_globals()
+                    subconfig.check_duplicates(entry["hosts"], stanza_names)
+                else:
+                    tmp_path, hostnames = FragmentWriter._render(
+                        path,
+                        lambda fd: subconfig.output_own(ConfigOutput(fd), stanza_names),
+                    )
+                    pending.append((path, tmp_path))
+                    entry = {"digest": digest, "hosts": hostnames}
+                fragments[name] = entry
+
+            includes = header + "".join(
+                FragmentWriter.include_line(os.path.join(self.directory, t)) + "\n"
+                for t in fragments
+            )
+            try:
+                with open(output_file) as fd:
+                    unchanged = fd.read() == includes
+            except OSError:
+                unchanged = False
+            if not unchanged:
+                tmp_path, _ = FragmentWriter._render(
+                    output_file, lambda fd: fd.write(includes)
+                )
+                pending.append((output_file, tmp_path))
+
+            while pending:
+                path, tmp_path = pending[0]
+                if on_replace is not None:
+                    on_replace(path, tmp_path)
+                os.replace(tmp_path, path)
+                pending.pop(0)
+        finally:
+            for _, tmp_path in pending:
+                os.unlink(tmp_path)
+        for name, entry in fragments.items():
+            entry["stamp"] = output_stamp(os.path.join(self.directory, name))
+
+        for name in set(previous) - set(fragments):
+            try:
+                os.unlink(os.path.join(self.directory, name))
+            except OSError:
+                pass
+        self._save(fragments)
+        SedgeEngine.write_hosts(stanza_names)
+        return [output_file] + [os.path.join(self.directory, t) for t in fragments]
@@ -0,0 +1,91 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from . import sedge_version
+from .engine import SedgeEngine
+from .urlhandling import get_contents, make_session
+
+
+def output_stamp(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+
+class UpdateManifest:
+    """
+    records the inputs to a `sedge update': the options, the text of the
+    configuration file and each of its includes, the state of the key
+    library, and the output files written. if none of these have changed,
+    a later update has nothing to do.
+    """
+
+    version = 1
+
+    def __init__(self, path):
+        self._path = path
+
+    def _load(self):
+        try:
+            with open(self._path) as fd:
+                manifest = json.load(fd)
+        except (OSError, ValueError):
+            return {}
+        if manifest.get("version") != UpdateManifest.version:
+            return {}
+        return manifest["outputs"]
+
+    def record(self, output_file, options, engine, key_library, output_files):
+        records = self._load()
+        records[output_file] = {
+            "sedge": sedge_version(),
+            "options": options,
+            "sources": engine.sources(),
+            "keys": key_library.state() if engine.key_fingerprints() else None,
+            "outputs": dict((t, output_stamp(t)) for t in output_files),
+        }
+        manifest = {"version": UpdateManifest.version, "outputs": records}
+        tmp_path = self._path + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+            with open(tmp_path, "w") as fd:
+                json.dump(manifest, fd)
+            os.replace(tmp_path, self._path)
+        except OSError:
+            pass
+
+    def is_current(self, output_file, options, key_library, verify_ssl, cache=None):
+        """
+        returns True if the last update of output_file had the same inputs
+        as we have now, and its outputs haven't been touched since. the
+        cheap checks come first; HTTPS includes are revalidated last.
+        """
+        record = self._load().get(output_file)
+        if record is None:
+            return False
+        if record["sedge"] != sedge_version() or record["options"] != options:
+            return False
+        for path, stamp in record["outputs"].items():
+            if output_stamp(path) != stamp:
+                return False
+        if record["keys"] is not None and record["keys"] != key_library.state():
+            return False
+
+        def source_digest(url):
+            try:
+                text = get_contents(url, verify_ssl, cache, session)
+            except Exception:
+                return None
+            return SedgeEngine.digest(text)
+
+        urls = [t for t, _ in record["sources"]]
+        session = make_session()
+        try:
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                digests = list(executor.map(source_digest, urls))
+        finally:
+            session.close()
+        return digests == [t for _, t in record["sources"]]
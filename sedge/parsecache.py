@@ -0,0 +1,68 @@
+import os
+import pickle
+from tempfile import NamedTemporaryFile
+
+
+class ParseCache:
+    """
+    on-disk cache of the state of a SedgeEngine after parsing, keyed by a
+    hash of everything the parse depends on (see SedgeEngine._parse_key)
+    """
+
+    # bump this whenever the parsed state changes shape
+    version = 3
+    # small files parse faster than their cache entry can be loaded
+    min_lines = 200
+    # beyond this many entries, the least recently used are removed
+    max_entries = 64
+
+    def __init__(self, path):
+        self._path = path
+
+    def _entry_path(self, key):
+        return os.path.join(self._path, "{}-{}.pickle".format(ParseCache.version, key))
+
+    def get(self, key):
+        path = self._entry_path(key)
+        try:
+            with open(path, "rb") as fd:
+                state = pickle.load(fd)
+        except Exception:
+            return None
+        try:
+            # record the use, for _prune
+            os.utime(path)
+        except OSError:
+            pass
+        return state
+
+    def store(self, key, state):
+        try:
+            os.makedirs(self._path, exist_ok=True)
+            tmp_file = NamedTemporaryFile(mode="wb", dir=self._path, delete=False)
+            with tmp_file:
+                pickle.dump(state, tmp_file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_file.name, self._entry_path(key))
+            self._prune()
+        except OSError:
+            pass
+
+    def _prune(self):
+        """
+        remove entries written by other versions, and all but the
+        max_entries most recently used
+        """
+        prefix = "{}-".format(ParseCache.version)
+        entries = []
+        with os.scandir(self._path) as it:
+            for entry in it:
+                if not entry.name.endswith(".pickle"):
+                    continue
+                if entry.name.startswith(prefix):
+                    entries.append((entry.stat().st_mtime_ns, entry.path))
+                else:
+                    os.unlink(entry.path)
+        entries.sort(reverse=True)
+        keep = ParseCache.max_entries
+        for _, path in entries[keep:]:
+            os.unlink(path)
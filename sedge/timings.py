@@ -0,0 +1,60 @@
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Timings:
+    """
+    wall time spent in each phase of a run, and counters of the work done
+    in it. nothing is recorded unless `enabled` is set, so that the calls
+    made from the engine and key library cost next to nothing normally.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.phases = {}
+        self.counters = {}
+
+    @contextmanager
+    def phase(self, name):
+        """
+        time the enclosed block as phase `name`. a phase entered more than
+        once (or from several threads at once) accumulates its time.
+        """
+        if not self.enabled:
+            yield
+            return
+        with self._lock:
+            self.phases.setdefault(name, 0.0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.phases[name] += elapsed
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def report(self):
+        return {"phases": dict(self.phases), "counters": dict(self.counters)}
+
+    def format(self):
+        """
+        returns the report as lines of text, in the order the phases began
+        """
+        lines = ["%-16s %9.3fs" % (name, t) for name, t in self.phases.items()]
+        lines += ["%-16s %10d" % (name, n) for name, n in sorted(self.counters.items())]
+        return lines
+
+
+# shared by the whole process; the CLI enables it for --timings
+timings = Timings()
@@ -1,40 +1,255 @@
+import hashlib
+import json
 import os
 import re
-import urllib.request
+import sys
+import threading
 import urllib.parse
-import requests
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import NamedTemporaryFile
+
 from .exceptions import SecurityException
+from .timings import timings
 
 is_https = re.compile(r"^https:")
 is_file = re.compile(r"^file:")
+# seconds to wait for a connection, and then between bytes of the response,
+# before giving up on an https @include (and using any cached copy)
+fetch_timeout = (10, 30)
+
+
+class IncludeCache:
+    """
+    on-disk cache of HTTPS @include bodies, keyed by URL, along with the
+    validators (ETag, Last-Modified) needed to revalidate them
+    """
+
+    def __init__(self, path):
+        self._path = path
+
+    def _entry_path(self, url):
+        return os.path.join(
+            self._path, hashlib.sha256(url.encode("utf8")).hexdigest() + ".json"
+        )
+
+    def get(self, url):
+        try:
+            with open(self._entry_path(url)) as fd:
+                entry = json.load(fd)
+        except (OSError, ValueError):
+            return None
+        if entry.get("url") != url:
+            return None
+        return entry
+
+    def store(self, url, response):
+        entry = {
+            "url": url,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "body": response.text,
+        }
+        try:
+            os.makedirs(self._path, exist_ok=True)
+            tmp_file = NamedTemporaryFile(mode="w", dir=self._path, delete=False)
+            with tmp_file:
+                json.dump(entry, tmp_file)
+            os.replace(tmp_file.name, self._entry_path(url))
+        except OSError:
+            print("warning: could not cache @include '{}'".format(url), file=sys.stderr)
+
+
+def local_path(target):
+    """
+    returns the path on disk of target, or None if it isn't local
+    """
+    if is_https.match(target):
+        return None
+    if is_file.match(target):
+        from urllib.request import url2pathname
 
+        return url2pathname(urllib.parse.urlparse(target).path)
+    return os.path.abspath(os.path.expanduser(target))
 
-def get_contents(target, verify_ssl):
+
+class LazySession:
+    """
+    a requests session, created on first use: importing requests is slow,
+    and most configurations have no HTTPS @includes. once closed, it can't
+    be used again.
+    """
+
+    def __init__(self, pool_size):
+        self._pool_size = pool_size
+        self._session = None
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def _get_session(self):
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("the session has been closed")
+            if self._session is None:
+                import requests
+
+                self._session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=self._pool_size, pool_maxsize=self._pool_size
+                )
+                self._session.mount("https://", adapter)
+            return self._session
+
+    def get(self, *args, **kwargs):
+        return self._get_session().get(*args, **kwargs)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+
+def make_session(pool_size=8):
+    """
+    returns a session with a keep-alive connection pool large enough for
+    `pool_size` concurrent fetches from the same host
+    """
+    return LazySession(pool_size)
+
+
+def get_contents(target, verify_ssl, cache=None, session=None):
+    """
+    as _get_contents(), recording the time taken
+    """
+    with timings.phase("fetch"):
+        return _get_contents(target, verify_ssl, cache, session)
+
+
+def _get_contents(target, verify_ssl, cache=None, session=None):
     """
     read the contents of target, which might be a https or file URL,
-    or just a local path
+    or just a local path. if a cache is given, https URLs are fetched
+    with a conditional GET, and the cached copy is used if the server
+    can't be reached or fails. https requests are made through session,
+    if given, so that connections are reused.
     """
 
     def assert_scheme(url, scheme):
         assert urllib.parse.urlparse(url).scheme == scheme
 
+    def stale(reason):
+        print(
+            "warning: using cached copy of '{}' ({})".format(target, reason),
+            file=sys.stderr,
+        )
+        return entry["body"]
+
     # use of a regular expression here is slightly naff, but it's
     # harmless and we are extremely limited in the URLs we will open,
     # and we double-check the scheme with urllib
     if is_https.match(target):
+        import requests
+
         assert_scheme(target, "https")
-        res = requests.get(target, verify=verify_ssl)
+        entry = cache.get(target) if cache is not None else None
+        headers = {}
+        if entry is not None:
+            if entry["etag"]:
+                headers["If-None-Match"] = entry["etag"]
+            if entry["last_modified"]:
+                headers["If-Modified-Since"] = entry["last_modified"]
+        try:
+            get = session.get if session is not None else requests.get
+            res = get(target, verify=verify_ssl, headers=headers, timeout=fetch_timeout)
+        except requests.RequestException as e:
+            if entry is None:
+                raise
+            return stale(repr(e))
+        if res.status_code == 304 and entry is not None:
+            return entry["body"]
+        if res.status_code >= 500 and entry is not None:
+            return stale("HTTP status {}".format(res.status_code))
         if res.status_code != 200:
             raise SecurityException(
                 "HTTP status {}: refusing to use contents of {}".format(
                     res.status_code, target
                 )
             )
+        # only bodies actually transferred count; not cache hits or fallbacks
+        timings.count("https bodies fetched")
+        timings.count("https bytes fetched", len(res.content))
+        if cache is not None:
+            cache.store(target, res)
         return res.text
 
     if is_file.match(target):
+        from urllib.request import urlopen
+
         assert_scheme(target, "file")
-        return urllib.request.urlopen(target).read().decode("utf8")
+        return urlopen(target).read().decode("utf8")
 
     with open(os.path.expanduser(target)) as fd:
         return fd.read()
+
+
+class IncludeFetcher:
+    """
+    fetches the contents of @include targets on a bounded pool of worker
+    threads. each fetched body is scanned for further @include targets
+    (using `find_includes`), which are queued as they are discovered, so
+    that by the time the parser reaches an @include its contents are
+    usually already available.
+    """
+
+    def __init__(
+        self, verify_ssl, find_includes, cache=None, session=None, max_workers=8
+    ):
+        self._verify_ssl = verify_ssl
+        self._cache = cache
+        self._session = session
+        self._find_includes = find_includes
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._futures = {}
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def _fetch(self, target):
+        contents = get_contents(target, self._verify_ssl, self._cache, self._session)
+        self.prefetch(contents)
+        return contents
+
+    def _submit(self, target):
+        with self._lock:
+            future = self._futures.get(target)
+            if future is None and not self._closed:
+                future = self._executor.submit(self._fetch, target)
+                self._futures[target] = future
+            return future
+
+    def prefetch(self, text):
+        """
+        queue a fetch of every @include target found in text
+        """
+        for target in self._find_includes(text):
+            self._submit(target)
+
+    def get_contents(self, target):
+        """
+        as get_contents(), but using the prefetched result if there is one
+        """
+        future = self._submit(target)
+        if future is None:
+            return get_contents(target, self._verify_ssl, self._cache, self._session)
+        return future.result()
+
+    def close(self):
+        """
+        stop fetching: queued fetches are cancelled, and those already
+        running won't queue any more
+        """
+        with self._lock:
+            self._closed = True
+            for future in self._futures.values():
+                future.cancel()
+        self._executor.shutdown(wait=False)
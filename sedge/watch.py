@@ -0,0 +1,326 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+
+from .engine import SedgeEngine
+from .exceptions import SedgeException
+from .urlhandling import get_contents, local_path
+
+
+def walk_tree(tree, prune=None):
+    """
+    as os.walk(), but not descending into directories for which
+    prune(path) is true
+    """
+    for dirpath, dirnames, fnames in os.walk(tree):
+        if prune is not None:
+            dirnames[:] = [t for t in dirnames if not prune(os.path.join(dirpath, t))]
+        yield dirpath, dirnames, fnames
+
+
+class PollingWatcher:
+    """
+    detects changes to files, and to files within directory trees, by
+    comparing their size, mtime and inode every `interval` seconds
+    """
+
+    def __init__(self, interval=1.0):
+        self._interval = interval
+        self._files = set()
+        self._trees = set()
+        self._snapshot = {}
+        self._prune = None
+
+    def watch(self, files, trees, prune=None):
+        """
+        watch files, and the files within trees; directories for which
+        prune(path) is true are skipped
+        """
+        self._files = set(files)
+        self._trees = set(trees)
+        self._prune = prune
+        self._snapshot = self._take_snapshot()
+
+    def _stamp(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+    def _take_snapshot(self):
+        snapshot = dict((t, self._stamp(t)) for t in self._files)
+        for tree in self._trees:
+            for dirpath, dirnames, fnames in walk_tree(tree, self._prune):
+                for name in fnames:
+                    path = os.path.join(dirpath, name)
+                    snapshot[path] = self._stamp(path)
+        return snapshot
+
+    def wait(self, timeout):
+        """
+        returns the set of paths changed, waiting up to timeout seconds
+        (forever, if timeout is None) for there to be any
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            snapshot = self._take_snapshot()
+            changed = set(
+                t
+                for t in set(snapshot) | set(self._snapshot)
+                if snapshot.get(t) != self._snapshot.get(t)
+            )
+            self._snapshot = snapshot
+            if changed:
+                return changed
+            delay = self._interval
+            if deadline is not None:
+                delay = min(delay, deadline - time.monotonic())
+                if delay <= 0:
+                    return set()
+            time.sleep(delay)
+
+
+class InotifyWatcher:
+    """
+    detects changes using Linux inotify(7). files are watched through
+    their directory, so that editors which replace a file are noticed.
+    """
+
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    mask = (
+        IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    )
+    event_header = struct.Struct("iIII")
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library("c")
+        if not sys.platform.startswith("linux") or libc_name is None:
+            raise OSError("inotify is not available")
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._dirs = {}
+
+    def _add_dir(self, path):
+        if path in self._dirs.values():
+            return
+        wd = self._libc.inotify_add_watch(
+            self._fd, os.fsencode(path), InotifyWatcher.mask
+        )
+        if wd >= 0:
+            self._dirs[wd] = path
+
+    def watch(self, files, trees, prune=None):
+        for path in files:
+            self._add_dir(os.path.dirname(path))
+        for tree in trees:
+            for dirpath, dirnames, fnames in walk_tree(tree, prune):
+                self._add_dir(dirpath)
+
+    def wait(self, timeout):
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return set()
+        data = os.read(self._fd, 65536)
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = InotifyWatcher.event_header.unpack_from(
+                data, offset
+            )
+            offset += InotifyWatcher.event_header.size
+            end = offset + length
+            name = data[offset:end].rstrip(b"\0")
+            offset = end
+            if wd in self._dirs:
+                changed.add(os.path.join(self._dirs[wd], os.fsdecode(name)))
+        return changed
+
+    def close(self):
+        os.close(self._fd)
+
+
+def make_watcher(poll=False, interval=1.0):
+    """
+    returns an inotify watcher where we can, otherwise a polling watcher
+    """
+    if not poll:
+        try:
+            return InotifyWatcher()
+        except (OSError, AttributeError):
+            pass
+    return PollingWatcher(interval)
+
+
+class ConfigWatch:
+    """
+    holds a parsed configuration and its key library in memory, and keeps
+    them up to date as their inputs change: a changed @include is parsed
+    again on its own, and a change to the key directory only re-resolves
+    the identities in use
+    """
+
+    def __init__(
+        self, config_file, key_library, verify_ssl, include_cache=None, parse_cache=None
+    ):
+        self._config_file = config_file
+        self._key_library = key_library
+        self._verify_ssl = verify_ssl
+        self._include_cache = include_cache
+        self._parse_cache = parse_cache
+        self.engine = None
+        self.load()
+
+    def load(self):
+        with open(self._config_file) as fd:
+            self.engine = SedgeEngine(
+                self._key_library,
+                fd,
+                self._verify_ssl,
+                url=self._config_file,
+                include_cache=self._include_cache,
+                parse_cache=self._parse_cache,
+            )
+
+    def _included(self):
+        """
+        yields (parent engine, index, url) for every @include in the tree
+        """
+        for engine in self.engine.engines():
+            for index, (url, _) in enumerate(engine.includes):
+                yield engine, index, url
+
+    def local_files(self):
+        """
+        returns the paths of the configuration file and each local include
+        """
+        paths = [os.path.abspath(self._config_file)]
+        for _, _, url in self._included():
+            path = local_path(url)
+            if path is not None:
+                paths.append(path)
+        return paths
+
+    def key_directory(self):
+        return os.path.abspath(self._key_library.path)
+
+    def _is_key_change(self, path):
+        return self._key_library.scans(path)
+
+    def is_pruned(self, path):
+        """
+        returns True for a directory within the key directory which is
+        never scanned, so needn't be watched
+        """
+        return not self._key_library.scans(path, is_dir=True)
+
+    def apply(self, changed):
+        """
+        bring the configuration up to date with the given changed paths.
+        returns True if anything was reloaded.
+        """
+        changed = set(os.path.abspath(t) for t in changed)
+        if os.path.abspath(self._config_file) in changed:
+            self.load()
+            return True
+        reloaded = False
+        for parent, index, url in list(self._included()):
+            path = local_path(url)
+            if path is None or path not in changed:
+                continue
+            # skip includes within a subtree we've just reloaded
+            if parent not in set(self.engine.engines()):
+                continue
+            reloaded = self._reload(parent, index, url) or reloaded
+        if any(self._is_key_change(t) for t in changed):
+            self._key_library.reset()
+            reloaded = True
+        if reloaded:
+            self.engine.refresh_identities()
+        return reloaded
+
+    def refresh_remote(self):
+        """
+        re-fetch each HTTPS @include, reloading those which have changed.
+        returns True if anything was reloaded.
+        """
+        reloaded = False
+        for parent, index, url in list(self._included()):
+            if local_path(url) is not None:
+                continue
+            if parent not in set(self.engine.engines()):
+                continue
+            if self._reload(parent, index, url):
+                reloaded = True
+        if reloaded:
+            self.engine.refresh_identities()
+        return reloaded
+
+    def _reload(self, parent, index, url):
+        try:
+            contents = get_contents(url, self._verify_ssl, self._include_cache)
+        except Exception as e:
+            print("skipping reload of `{}': {}".format(url, repr(e)), file=sys.stderr)
+            return False
+        _, current = parent.includes[index]
+        if SedgeEngine.digest(contents) == current.source_digest:
+            return False
+        parent.reload_include(index, contents)
+        return True
+
+
+def watch_loop(config_watch, watcher, regenerate, debounce=0.5, remote_interval=300):
+    """
+    regenerate the output whenever the inputs to config_watch change,
+    waiting for `debounce` seconds of quiet so that a burst of changes
+    results in one regeneration
+    """
+    watcher.watch(
+        config_watch.local_files(),
+        [config_watch.key_directory()],
+        config_watch.is_pruned,
+    )
+    next_remote = time.monotonic() + remote_interval
+    while True:
+        changed = watcher.wait(max(0, next_remote - time.monotonic()))
+        if changed:
+            while True:
+                more = watcher.wait(debounce)
+                if not more:
+                    break
+                changed |= more
+        reloaded = False
+        if changed:
+            try:
+                reloaded = config_watch.apply(changed)
+            except (SedgeException, OSError) as e:
+                print("error reloading configuration: {}".format(e), file=sys.stderr)
+        if time.monotonic() >= next_remote:
+            next_remote = time.monotonic() + remote_interval
+            reloaded = config_watch.refresh_remote() or reloaded
+        if reloaded:
+            try:
+                regenerate(config_watch.engine)
+            except (SedgeException, OSError) as e:
+                # the output is replaced atomically, so the previous output
+                # is still in place
+                print("error writing configuration: {}".format(e), file=sys.stderr)
+            # discard the changes made by writing the output, and pick up
+            # any includes which have been added or removed
+            watcher.wait(0)
+            watcher.watch(
+                config_watch.local_files(),
+                [config_watch.key_directory()],
+                config_watch.is_pruned,
+            )
@@ -0,0 +1,177 @@
+import os
+import shutil
+import ssl
+import subprocess
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from click.testing import CliRunner
+
+from sedge.cli import cli
+
+
+class StandInServer(ThreadingHTTPServer):
+    """
+    a local HTTPS server standing in for a remote @include host. serves
+    `pages` (path -> body), optionally with a delay per request, and
+    records the requests and TLS connections it sees, and the most
+    requests it has handled at once
+    """
+
+    daemon_threads = True
+
+    def __init__(self, context):
+        super().__init__(("127.0.0.1", 0), StandInHandler)
+        self.socket = context.wrap_socket(self.socket, server_side=True)
+        self.pages = {}
+        self.etags = {}
+        self.status = None
+        self.delay = 0
+        self.requests = []
+        self.connections = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.lock = threading.Lock()
+
+    def get_request(self):
+        request = super().get_request()
+        self.connections += 1
+        return request
+
+    def url(self, path):
+        return "https://127.0.0.1:{}{}".format(self.server_address[1], path)
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.in_flight += 1
+            server.peak_in_flight = max(server.peak_in_flight, server.in_flight)
+        try:
+            self.respond()
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def respond(self):
+        self.server.requests.append((self.path, dict(self.headers)))
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        body = self.server.pages.get(self.path)
+        etag = self.server.etags.get(self.path)
+        status = self.server.status
+        if status is None:
+            status = 200 if body is not None else 404
+            if etag is not None and self.headers.get("If-None-Match") == etag:
+                status = 304
+        if status != 200:
+            self.send_response(status)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = body.encode("utf8")
+        self.send_response(200)
+        if etag is not None:
+            self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def make_certificate(directory):
+    """
+    generate a self-signed certificate for 127.0.0.1, returning the
+    (certfile, keyfile) paths
+    """
+    certfile = os.path.join(directory, "cert.pem")
+    keyfile = os.path.join(directory, "key.pem")
+    subprocess.check_call(
+        [
+            "openssl",
+            "req",
+            "-x509",
+            "-newkey",
+            "rsa:2048",
+            "-nodes",
+            "-days",
+            "1",
+            "-subj",
+            "/CN=127.0.0.1",
+            "-addext",
+            "subjectAltName=IP:127.0.0.1",
+            "-keyout",
+            keyfile,
+            "-out",
+            certfile,
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return certfile, keyfile
+
+
+def start_server(certfile, keyfile):
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certfile, keyfile)
+    server = StandInServer(context)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+@pytest.fixture
+def https_server(tmp_path):
+    """
+    yields (server, cafile); pass cafile as verify_ssl to trust the server
+    """
+    if shutil.which("openssl") is None:
+        pytest.skip("openssl is required to generate a test certificate")
+    certfile, keyfile = make_certificate(str(tmp_path))
+    server = start_server(certfile, keyfile)
+    yield server, certfile
+    server.shutdown()
+    server.server_close()
+
+
+class SedgeHome:
+    """
+    a scratch home directory for running the CLI: the configuration file
+    is `config_file`, the output and key directory are under ssh/, and
+    sedge keeps its state in .sedge/
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.config_file = path / "config.sedge"
+        self.output_file = path / "ssh" / "config"
+        self.args = [
+            "-c",
+            str(self.config_file),
+            "-o",
+            str(self.output_file),
+            "-k",
+            str(path / "ssh"),
+        ]
+        self.runner = CliRunner()
+
+    def invoke(self, *args):
+        """
+        run sedge with args, against this home's configuration
+        """
+        return self.runner.invoke(cli, self.args + list(args))
+
+
+@pytest.fixture
+def sedge_home(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    (tmp_path / ".sedge").mkdir()
+    (tmp_path / "ssh").mkdir()
+    return SedgeHome(tmp_path)
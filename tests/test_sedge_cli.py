@@ -1,3 +1,8 @@
+import json
+import os
+import subprocess
+import sys
+
 from click.testing import CliRunner
 
 from sedge.cli import cli, init, update, keys
@@ -17,12 +22,18 @@ Options:
   -o, --output-file TEXT
   -n, --no-verify           do not verify HTTPS requests
   -k, --key-directory TEXT  directory to scan for SSH keys
+  --key-ignore PATTERN      skip matching names when scanning for SSH keys
   -v, --verbose
+  --max-diff-lines N        show at most N lines of diff with -v
   --help                    Show this message and exit.
 Commands:
-  init    Initialise ~./sedge/config file if none exists.
-  keys    Manage ssh keys
-  update  Update ssh config from sedge specification
+  complete  List the hosts whose names start with a prefix
+  init      Initialise ~./sedge/config file if none exists.
+  keys      Manage ssh keys
+  plan      Estimate the size of the ssh config, without generating it
+  query     Show the ssh config generated for a host
+  update    Update ssh config from sedge specification
+  watch     Keep ssh config up to date as the sedge specification changes
 """.replace(
             "\n", ""
         )
@@ -57,7 +68,12 @@ def test_update_help():
   Update ssh config from sedge specification
 
 Options:
-  --help  Show this message and exit.
+  --timings [text|json]  report the time taken by each phase of the update
+  --profile PATH         write cProfile statistics for the update to PATH
+  --fragments            write each source to its own file, under sedge.d/
+  --max-hosts N          abort if the output would have more than N hosts
+  --max-bytes N          abort if the output would be larger than about N bytes
+  --help                 Show this message and exit.
 """
     )
 
@@ -80,3 +96,163 @@ Commands:
   list
 """
     )
+
+
+def test_update_unchanged_is_noop(sedge_home):
+    config_file = sedge_home.config_file
+    output_file = sedge_home.output_file
+    config_file.write_text("Host one\n")
+
+    result = sedge_home.invoke("update")
+    assert result.exit_code == 0
+    assert "Host = one" in output_file.read_text()
+    before = os.stat(str(output_file))
+
+    result = sedge_home.invoke("-v", "update")
+    assert result.exit_code == 0
+    assert result.output == "no changes.\n"
+    after = os.stat(str(output_file))
+    assert (after.st_ino, after.st_mtime_ns) == (before.st_ino, before.st_mtime_ns)
+
+    config_file.write_text("Host two\n")
+    result = sedge_home.invoke("update")
+    assert result.exit_code == 0
+    assert "Host = two" in output_file.read_text()
+
+
+def test_update_timings(sedge_home):
+    sedge_home.config_file.write_text("@with i {1..3}\nHost node<i>\n    User <i>\n")
+    profile = sedge_home.path / "update.prof"
+    result = sedge_home.invoke("update", "--timings", "json", "--profile", str(profile))
+    assert result.exit_code == 0
+    # the report is the only output, on stderr
+    report = json.loads(result.output)
+    assert {"update", "parse", "output"} <= set(report["phases"])
+    assert report["counters"]["stanzas"] == 3
+    assert report["counters"]["substitutions"] == 6
+    # the configuration is local; nothing was fetched
+    assert "https bodies fetched" not in report["counters"]
+    assert profile.stat().st_size > 0
+
+
+def test_update_fragments(sedge_home):
+    a = sedge_home.path / "a.sedge"
+    b = sedge_home.path / "b.sedge"
+    config_file = sedge_home.config_file
+    output_file = sedge_home.output_file
+    a.write_text("Host a\n")
+    b.write_text("Host b\nHost shared\n")
+    config_file.write_text('Host shared\n@include "%s"\n@include "%s"\n' % (a, b))
+
+    result = sedge_home.invoke("update", "--fragments")
+    assert result.exit_code == 0
+    assert "duplicated hosts parsing '%s'" % b in result.output
+    fragment_dir = sedge_home.path / "ssh" / "sedge.d"
+    includes = [
+        t.split(" = ")[1]
+        for t in output_file.read_text().splitlines()
+        if t.startswith("Include")
+    ]
+    assert [os.path.dirname(t) for t in includes] == [str(fragment_dir)] * 3
+    assert "Host = a" in open(includes[1]).read()
+    stamps = [os.stat(t).st_mtime_ns for t in includes]
+
+    # only the fragment for the changed include is rewritten, and hosts in
+    # fragments which weren't rewritten are still checked for duplicates
+    b.write_text("Host b2\nHost shared\n")
+    result = sedge_home.invoke("update", "--fragments")
+    assert result.exit_code == 0
+    assert "duplicated hosts parsing '%s'" % b in result.output
+    assert [os.stat(t).st_mtime_ns for t in includes][:2] == stamps[:2]
+    assert "Host = b2" in open(includes[2]).read()
+
+    # fragments for includes which have gone are removed
+    config_file.write_text('@include "%s"\n' % a)
+    result = sedge_home.invoke("update", "--fragments")
+    assert result.exit_code == 0
+    assert not os.path.exists(includes[2])
+    assert sorted(os.listdir(str(fragment_dir))) == sorted(
+        [".sedge-fragments.json", "root.conf", os.path.basename(includes[1])]
+    )
+
+
+def test_complete(sedge_home):
+    sedge_home.config_file.write_text(
+        "@with i {8..11}\nHost node<i>\nHost nas\nHost *.lan\n"
+    )
+    result = sedge_home.invoke("complete", "n")
+    assert result.exit_code == 0
+    assert result.output == ""
+    result = sedge_home.invoke("update")
+    assert result.exit_code == 0
+    result = sedge_home.invoke("complete", "node1")
+    assert result.output == "node10\nnode11\n"
+    result = sedge_home.invoke("complete")
+    assert result.output == "nas\nnode10\nnode11\nnode8\nnode9\n"
+    # a damaged index is ignored, like a missing one
+    (sedge_home.path / ".sedge" / "hosts.idx").write_bytes(b"SEDGEHIX")
+    result = sedge_home.invoke("complete")
+    assert result.exit_code == 0
+    assert result.output == ""
+
+
+def test_update_budget(sedge_home):
+    config_file = sedge_home.config_file
+    output_file = sedge_home.output_file
+    config_file.write_text("@with i {0..99999}\nHost node<i>\nHost one\n")
+
+    result = sedge_home.invoke("plan")
+    assert result.exit_code == 0
+    assert result.output.splitlines()[-1].split()[:2] == ["100001", "100001"]
+
+    result = sedge_home.invoke("update", "--max-hosts", "1000")
+    assert result.exit_code == 1
+    assert "100001 hosts, more than --max-hosts 1000" in result.output
+    assert "%s:2 node<i>: 100000 hosts" % config_file in result.output
+    assert not output_file.exists()
+
+    result = sedge_home.invoke("update", "--max-bytes", "100")
+    assert result.exit_code == 1
+    assert not output_file.exists()
+
+    config_file.write_text("Host one\n")
+    result = sedge_home.invoke("update", "--max-hosts", "1000")
+    assert result.exit_code == 0
+    assert output_file.exists()
+
+
+# modules which are slow to import, and are only needed for HTTPS includes
+# or not at all
+SLOW_IMPORTS = ("requests", "urllib.request", "http.client", "pkg_resources")
+# loaded only by the commands which need them, and not by `sedge complete'
+COMMAND_IMPORTS = ("sedge.engine", "sedge.keylib", "sedge.watch", "sedge.fragments")
+# the cumulative import time of sedge.cli, in microseconds
+IMPORT_BUDGET = 250000
+
+
+def cli_import_times():
+    """
+    returns {module: cumulative import time} for `import sedge.cli`,
+    as reported by `python -X importtime`
+    """
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import sedge.cli"],
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line.split("|")
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+def test_cli_import_budget():
+    times = min((cli_import_times() for _ in range(3)), key=lambda t: t["sedge.cli"])
+    assert [t for t in SLOW_IMPORTS if t in times] == []
+    assert [t for t in COMMAND_IMPORTS if t in times] == []
+    assert times["sedge.cli"] < IMPORT_BUDGET